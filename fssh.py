@@ -12,25 +12,45 @@
 #       macros that apply filters and commands for common tasks
 
 # To Do:
-# [main] section in config file
 # Make available pillars print with ? (if available)
 # Print last jid with ? as well (add self.jid)
 
+import atexit
+import array
+import ast
+import base64
+import bisect
+import collections
+import ctypes
+import ctypes.util
 import ConfigParser
+import cStringIO
+import difflib
 import fcntl
+import fnmatch
+import gzip
+import hashlib
+import itertools
 import json
 import optparse
 import os
+import pipes
 #from pprint import pprint
 import pwd
+import Queue
 import re
 import readline
 import socket
+import sqlite3
+import stat
 import struct
 import sys
 import termios
+import threading
+import time
 
 history_file = '~/.salt_history'
+cache_dir = '~/.fssh_cache'
 
 p = optparse.OptionParser(usage="%prog [opts] [scripts]")
 p.add_option('-v', '--verbose', dest="verbose", action="store_true", default=False,
@@ -39,12 +59,27 @@ p.add_option('-i', '--interactive', dest="interactive", action="store_true", def
              help="Start an interactive shell after processing all files")
 p.add_option('-n', '--noop', dest="noop", action="store_true", default=False,
             help="Don't actually do anything, just show what would be done."
-            " Useful for generating CLI commands. Job lookups can still be performed.")
+            " Useful for generating CLI commands, and needs neither root nor salt."
+            " Job lookups can still be performed (as root).")
 p.add_option('-p','--no-pillars', dest='use_pillars', action="store_false", default=True,
             help="Don't load (or support) pillars."
             " This is useful for faster debugging and troubleshooting fssh itself.")
 p.add_option('-c', '--config', dest="config", action="store", default='/etc/fssh.conf',
              help="Config file to use. Default=/etc/fssh.conf")
+p.add_option('-o', '--output-dir', dest='output_dir', action="store", default=None, metavar="DIR",
+             help="Write every minion's output to files under DIR instead of printing it.")
+p.add_option('--serial', dest='serial', action="store_true", default=False,
+             help="Publish the jobs of script files one after the other instead of pipelining them.")
+p.add_option('--refresh-pillars', dest='refresh_pillars', action="store_true", default=False,
+             help="Ignore the on-disk pillar cache and load pillars from the master.")
+p.add_option('--server', dest='server', action="store", default=None, metavar="SOCKET",
+             help="Stay running and serve requests from 'fssh --connect' on this unix socket.")
+p.add_option('--connect', dest='connect', action="store", default=None, metavar="SOCKET",
+             help="Send the scripts to an 'fssh --server' on this socket instead of running them here.")
+p.add_option('--wait', dest='wait', action="store_true", default=False,
+             help="With --connect, wait for the submitted jobs and include their returns.")
+p.add_option('--json', dest='json', action="store_true", default=False,
+             help="With --connect, print the server's whole reply as json.")
 opts, files = p.parse_args()
 
 if not files or opts.interactive:
@@ -52,41 +87,235 @@ if not files or opts.interactive:
 
 opts.user = os.environ.get('SUDO_USER', pwd.getpwuid(os.getuid()).pw_name)
 
-if os.geteuid() != 0:
+def run_client(path, files):
+    """ Hand the scripts to a running 'fssh --server'. This runs before
+        the sudo re-exec and the salt imports, which are the whole point
+        of not starting an fssh of our own. """
+    lines = []
+    for f in files:
+        fd = hasattr(f, 'readline') and f or open(f)
+        lines += [l.strip() for l in fd if l.strip() and not l.startswith('#')]
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except socket.error as e:
+        print >>sys.stderr, "Can't connect to fssh server at {0}: {1}".format(path, e)
+        return 2
+    conn.sendall(json.dumps({'lines': lines, 'wait': opts.wait}) + '\n')
+    reply = ''
+    while True:
+        data = conn.recv(65536)
+        if not data:
+            break
+        reply += data
+    conn.close()
+    reply = json.loads(reply)
+    if opts.json:
+        print json.dumps(reply, indent=4, sort_keys=True)
+    else:
+        sys.stdout.write(reply.get('output', '').encode('utf-8'))
+    return reply.get('error') and 1 or 0
+
+if opts.connect:
+    sys.exit(run_client(opts.connect, files))
+
+jid_re = r'\d+(?:@[\w.-]+)?'
+
+def is_host_list(line):
+    """ '= host1,host2,...', as opposed to '= pillar == value'. """
+    return line[0] == '=' and len(re.split(r'[\s,]+', line[1:].strip())) > 1 \
+        and line.split()[2:3] not in [['=='], ['!=']]
+
+# Every command there is, as (name, regex or test, kind, offline), tried
+# in order. 'filter' and 'setting' lines only change the session, a
+# 'task' submits a job and a 'query' looks at jobs or other things a job
+# can change. Offline commands don't need salt. Anything else is a task.
+commands = [
+    ('source',   r'^\.', 'setting', False),
+    ('help',     r'^help$', 'query', True),
+    ('clear',    r'^(clear|reset)$', 'query', True),
+    ('refresh',  r'^refresh$', 'query', False),
+    ('exit',     r'^(exit|quit)$', 'query', True),
+    ('meow',     r'^meow$', 'query', True),
+    ('batch',    r'^batch( (off|\d+%?)( \d+%)?)?$', 'setting', True),
+    ('put',      r'^put( |$)', 'query', False),
+    ('group',    r'^group( on| off)?$', 'setting', True),
+    ('output',   r'^output( \S+)?$', 'setting', False),
+    ('jobs',     r'^jobs$', 'query', False),
+    ('timing',   r'^timing( ' + jid_re + ')?$', 'query', False),
+    ('wait',     r'^(wait|retry)( ' + jid_re + ')?$', 'query', False),
+    ('watch',    r'^watch( ' + jid_re + ')?$', 'query', False),
+    ('reduce',   r'^reduce( |$)', 'query', False),
+    ('lookup',   r'^\?\?', 'query', False),
+    ('summary',  r'^\?$', 'query', True),
+    ('query',    r'^\?', 'query', False),
+    ('hostfile', r'^<', 'filter', True),
+    ('hostlist', is_host_list, 'filter', True),
+    ('filter',   r'^[-+=]', 'filter', True),
+]
+
+# '| stats $N' and '| hist $N' after a lookup. A command gets
+# 'reduce stats $N command' instead, its own '|' is the shell's.
+reduction_re = re.compile(r'^(\?\??|\? *' + jid_re + '|watch(?: ' + jid_re + r')?) *\| *(stats|hist) +\$(\d+)$')
+reduce_re = re.compile(r'^reduce +(stats|hist) +\$(\d+) +(\S.*)$')
+
+def find_command(line):
+    """ (name, kind, offline) of a command line. """
+    for name, test, kind, offline in commands:
+        if callable(test) and test(line) or not callable(test) and re.match(test, line):
+            return name, kind, offline
+    return 'task', 'task', False
+
+def is_offline(files):
+    """ Whether this session can do without salt altogether: -n, or
+        scripts that only build filters and print them. Those don't
+        need root, salt or the master's config, and so don't get any. """
+    if opts.noop:
+        return True
+    if opts.server or any(hasattr(f, 'readline') for f in files):
+        return False
+    for f in files:
+        try:
+            with open(f) as fd:
+                for line in fd:
+                    line = line.strip()
+                    if line and not line.startswith('#') and not find_command(line)[2]:
+                        return False
+        except (OSError, IOError):
+            return False
+    return True
+
+opts.offline = is_offline(files)
+
+if os.geteuid() != 0 and not opts.offline:
     print "Not launched via sudo, fixing that for you."
     os.execvp("sudo", ["sudo"] + sys.argv)
 
-# You might have to be root to even load the libraries
-# if people add custom code to create files that get run as root, etc
-# so load these after the root check
-import salt.client
-import salt.runner
+class NeedsRoot(Exception):
+    def __str__(self):
+        return "Talking to salt needs root. Run this without -n, or through sudo."
+
+def load_salt():
+    """ Import salt the first time something talks to a master, rather
+        than for every session. You might have to be root to even load
+        the libraries if people add custom code to create files that get
+        run as root, etc, so an offline session stops here, with
+        NeedsRoot for whatever command got it this far. """
+    global salt
+    if os.geteuid() != 0:
+        raise NeedsRoot()
+    import salt.client
+    import salt.config
+    import salt.runner
+    return salt
 
 def get_columns():
     COLUMNS = 80
     if 'COLUMNS' in os.environ:
         COLUMNS = int(os.environ['COLUMNS'])
     else:
-        ROWS, COLUMNS = struct.unpack('hh', fcntl.ioctl(sys.stdin, termios.TIOCGWINSZ, '1234'))
+        try:
+            ROWS, COLUMNS = struct.unpack('hh', fcntl.ioctl(sys.stdin, termios.TIOCGWINSZ, '1234'))
+        except IOError:
+            pass
     return COLUMNS
 
 def _padder(tosay = ''):
     print "{0}".format(tosay).center(get_columns(), '-')
 
+def filter_text(filter):
+    return " ".join(str(f) for f in filter)
+
 def display_filters(list):
     _padder(" Current filters to apply: ")
     for filter in list:
-        print " ".join(filter)
-
-def get_salt_filters(list, pillars):
-    salt_filters = []
+        print filter_text(filter)
+
+def _trie_regex(node):
+    """ Turn one level of a character trie into a regex. Leaves
+        that end right after one character get folded into a class. """
+    optional = '' in node
+    branches = []
+    singles = []
+    for char in sorted(k for k in node if k):
+        tail = _trie_regex(node[char])
+        if tail:
+            branches.append(re.escape(char) + tail)
+        else:
+            singles.append(re.escape(char))
+    if len(singles) == 1:
+        branches.append(singles[0])
+    elif singles:
+        branches.append("[{0}]".format(''.join(singles)))
+    if not branches:
+        return ''
+    if len(branches) == 1 and not optional:
+        return branches[0]
+    regex = "(?:{0})".format('|'.join(branches))
+    if optional:
+        regex += '?'
+    return regex
+
+def hosts_to_regex(hosts):
+    """ Compress a list of hostnames into one regex matching exactly
+        those hosts, by building a trie so shared prefixes only show up
+        once. The domain most hosts share is pulled out first, since a
+        prefix trie can't share a common suffix. E@ is an re.match, so
+        only the end needs anchoring. """
+    suffix = os.path.commonprefix([host[::-1] for host in hosts])[::-1]
+    if len(hosts) == 1:
+        suffix = ''
+    trie = {}
+    for host in hosts:
+        node = trie
+        for char in host[:len(host) - len(suffix)]:
+            node = node.setdefault(char, {})
+        node[''] = {}
+    return "{0}{1}$".format(_trie_regex(trie), re.escape(suffix))
+
+def read_host_file(fd):
+    """ One host per line, skipping blank lines and # comments. """
+    hosts = []
+    for line in fd:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            hosts.append(line)
+    return hosts
+
+def shard_hosts(hosts, limit):
+    """ Split a sorted host list into as few regexes as it takes to
+        keep every one of them under limit characters. Sorted input
+        keeps hosts sharing a prefix in the same shard. """
+    regex = hosts_to_regex(hosts)
+    if len(regex) <= limit or len(hosts) == 1:
+        return [regex]
+    half = len(hosts) // 2
+    return shard_hosts(hosts[:half], limit) + shard_hosts(hosts[half:], limit)
+
+class HostList(object):
+    """ An explicit list of hosts to target, from '<' or '='. It is
+        sent as one or more compressed regexes, and when it takes more
+        than one the command gets split into one job per regex. """
+
+    def __init__(self, hosts, limit):
+        self.hosts = sorted(set(hosts))
+        self.shards = shard_hosts(self.hosts, limit)
+
+    def __str__(self):
+        return "list of {0} hosts ({1} job{2})".format(len(self.hosts), len(self.shards),
+                                                       len(self.shards) > 1 and 's' or '')
+
+def filter_clauses(list):
+    """ Turn filter lines into (negated, matcher, expression) clauses. """
+    clauses = []
     for filter in list:
-        if len(filter) == 2:
+        if len(filter) == 3:
+            """ Host lists have to go through get_salt_targets
+                when they need more than one job. """
+            clauses.append((False, 'E', filter[2].shards[0]))
+        elif len(filter) == 2:
             """ Host/PCRE matching """
-            if filter[0] == '-':
-                salt_filters.append("not E@{0}".format(filter[1]))
-            else:
-                salt_filters.append("E@{0}".format(filter[1]))
+            clauses.append((filter[0] == '-', 'E', filter[1]))
         elif len(filter) == 4:
             """ Pillar matching
                 Shirley, this could be more elegant. """
@@ -100,21 +329,1193 @@ def get_salt_filters(list, pillars):
                 + state != live | not I@state:live
                 + state == live | I@state:live """
 
-            if filter[0] == '-':
-                if filter[2] == '!=':
-                    salt_filters.append("I@{0}:{1}".format(filter[1], filter[3]))
-                else:
-                    salt_filters.append("not I@{0}:{1}".format(filter[1], filter[3]))
-            else:
-                if filter[2] == '!=':
-                    salt_filters.append("not I@{0}:{1}".format(filter[1], filter[3]))
-                else:
-                    salt_filters.append("I@{0}:{1}".format(filter[1], filter[3]))
+            clauses.append((not pillar_filter_is_positive(filter), 'I', "{0}:{1}".format(filter[1], filter[3])))
         else:
             print >>sys.stderr, "This really shouldn't be possible. Bailing."
             sys.exit(999)
+    return clauses
+
+def optimize_clauses(clauses):
+    """ The master evaluates the compound matcher against every minion
+        on every publish, and it short circuits on 'and', so:
+            - drop duplicates, and clauses another one already implies
+              (E@.* next to anything else, I@key:* next to I@key:value)
+            - fold every excluded hostspec into a single 'not E@(?:a|b)'
+            - put the cheap regex matches before any pillar lookups
+        Included hostspecs are and'ed, so those stay separate clauses. """
+    unique = []
+    for clause in clauses:
+        if clause not in unique:
+            unique.append(clause)
+
+    matched = [c for c in unique if c != (False, 'E', '.*')]
+    unique = matched or unique[:1]
+
+    wanted = [e.split(':', 1) for n, m, e in unique if not n and m == 'I']
+    unique = [(n, m, e) for n, m, e in unique
+              if n or m != 'I' or not e.endswith(':*')
+              or not any(k == e[:-2] and v != '*' for k, v in wanted)]
+
+    excluded = [e for n, m, e in unique if n and m == 'E']
+    if len(excluded) > 1:
+        merged = (True, 'E', "(?:{0})".format('|'.join(excluded)))
+        unique = [c for c in unique if not (c[0] and c[1] == 'E')] + [merged]
+
+    return sorted(unique, key=lambda c: (c[1] == 'I', c[0]))
+
+def get_salt_filters(list, pillars):
+    salt_filters = []
+    for negated, matcher, expression in optimize_clauses(filter_clauses(list)):
+        salt_filters.append("{0}{1}@{2}".format(negated and 'not ' or '', matcher, expression))
     return " and ".join(salt_filters)
 
+def find_contradictions(list):
+    """ Filter stacks that can't match anything, no master needed. """
+    problems = []
+    clauses = filter_clauses([f for f in list if len(f) != 3])
+    for negated, matcher, expression in clauses:
+        if not negated and (True, matcher, expression) in clauses:
+            problems.append("{0}@{1} is both included and excluded.".format(matcher, expression))
+        elif negated and matcher == 'E' and expression == '.*':
+            problems.append("not E@.* excludes every host.")
+    return problems
+
+def get_salt_targets(list, pillars):
+    """ One compound target per job needed to cover the filters.
+        That is just the one, unless a host list had to be sharded. """
+    sharded = [(i, f[2].shards) for i, f in enumerate(list) if len(f) == 3]
+    if not sharded:
+        return [get_salt_filters(list, pillars)]
+    targets = []
+    for shards in itertools.product(*[s for i, s in sharded]):
+        expanded = [f for f in list]
+        for (i, s), shard in zip(sharded, shards):
+            expanded[i] = [expanded[i][0], shard]
+        targets.append(get_salt_filters(expanded, pillars))
+    return targets
+
+def pillar_filter_is_positive(filter):
+    """ The same truth table as get_salt_filters, boiled down to
+        whether the pillar clause ends up as I@ or not I@. """
+    return (filter[0] == '-') == (filter[2] == '!=')
+
+class PillarIndex(object):
+    """ A fleet wide snapshot of pillar data, inverted so that
+        key -> value -> set of minions. Minions are stored as small
+        integers so the sets stay compact and the set math for a
+        whole filter stack stays in the milliseconds even on a big fleet.
+
+        Nested pillars are flattened with ':' the same way salt's
+        I@ matcher walks them, and lists are indexed per element. Like
+        that matcher, values are compared without regard to case, so
+        folded maps key -> lower cased value -> the values as stored. """
+
+    def __init__(self):
+        self.minions = []
+        self.ids = {}
+        self.values = {}
+        self.folded = {}
+        self.digests = {}
+        self.entries = {}
+        self.free = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def _str(value):
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return str(value)
+
+    def _flatten(self, data, prefix=''):
+        for key, value in data.items():
+            key = prefix + self._str(key)
+            if isinstance(value, dict):
+                for item in self._flatten(value, key + ':'):
+                    yield item
+            elif isinstance(value, (list, tuple)):
+                for element in value:
+                    if not isinstance(element, (dict, list, tuple)):
+                        yield key, self._str(element)
+            else:
+                yield key, self._str(value)
+
+    def _remove(self, minion):
+        mid = self.ids.pop(minion)
+        for key, value in self.entries.pop(minion):
+            self.values[key][value].discard(mid)
+        self.minions[mid] = None
+        self.free.append(mid)
+        del self.digests[minion]
+
+    def _add(self, minion, pillar, digest):
+        if self.free:
+            mid = self.free.pop()
+            self.minions[mid] = minion
+        else:
+            mid = len(self.minions)
+            self.minions.append(minion)
+        self.ids[minion] = mid
+        self.digests[minion] = digest
+        self.entries[minion] = list(self._flatten(pillar))
+        for key, value in self.entries[minion]:
+            self.values.setdefault(key, {}).setdefault(value, set()).add(mid)
+            self.folded.setdefault(key, {}).setdefault(value.lower(), set()).add(value)
+
+    def update(self, pillars):
+        """ Apply a fresh {minion: pillar} snapshot. Only minions whose
+            pillar data actually changed (or appeared/disappeared) touch
+            the index, so refreshing is cheap when little has changed.
+            Returns the number of minions that were (re)indexed. """
+        changed = 0
+        for minion in [m for m in self.ids if m not in pillars]:
+            self._remove(minion)
+            changed += 1
+        for minion, pillar in pillars.items():
+            if not isinstance(pillar, dict):
+                continue
+            digest = hash(json.dumps(pillar, sort_keys=True, default=str))
+            if self.digests.get(minion) == digest:
+                continue
+            if minion in self.ids:
+                self._remove(minion)
+            self._add(minion, pillar, digest)
+            changed += 1
+        return changed
+
+    def all(self):
+        return set(self.ids.values())
+
+    def match_host(self, spec):
+        """ Salt's E@ matcher is a plain re.match against the minion id. """
+        try:
+            regex = re.compile(spec)
+        except re.error:
+            return set()
+        return set(mid for minion, mid in self.ids.items() if regex.match(minion))
+
+    def match_pillar(self, key, value):
+        values = self.values.get(key, {})
+        folded = self.folded.get(key, {})
+        value = value.lower()
+        if not any(c in value for c in '*?['):
+            candidates = folded.get(value, ())
+        else:
+            candidates = [original for lowered, originals in folded.items()
+                          if fnmatch.fnmatchcase(lowered, value) for original in originals]
+        matched = set()
+        for candidate in candidates:
+            matched |= values.get(candidate, set())
+        return matched
+
+    def match(self, filter):
+        """ The set of minions a single filter line would leave targeted. """
+        if len(filter) == 3:
+            return set(self.ids[host] for host in filter[2].hosts if host in self.ids)
+        elif len(filter) == 2:
+            matched = self.match_host(filter[1])
+            positive = filter[0] != '-'
+        else:
+            matched = self.match_pillar(filter[1], filter[3])
+            positive = pillar_filter_is_positive(filter)
+        if positive:
+            return matched
+        return self.all() - matched
+
+    def resolve(self, filters):
+        """ Returns a list of (filter, matches, cumulative matches)
+            in the same order the filters were added. """
+        results = []
+        current = self.all()
+        for filter in filters:
+            matched = self.match(filter)
+            current &= matched
+            results.append((filter, len(matched), len(current)))
+        return results
+
+    def select(self, filters):
+        """ The set of minions the whole filter stack targets. """
+        current = self.all()
+        for filter in filters:
+            current &= self.match(filter)
+        return current
+
+    def names(self, mids):
+        return sorted(self.minions[mid] for mid in mids)
+
+class Catalog(object):
+    """ Every pillar key, and every value the fleet has for it, in
+        sorted lists, so finding everything starting with a prefix is
+        two bisects however many values there are. pillar_map aliases
+        are keys too and complete to the values of the pillar they
+        stand for. A key nothing is known about has an empty list, and
+        then any value goes. """
+
+    def __init__(self, values, aliases):
+        self.values = dict((key, sorted(vals)) for key, vals in values.items())
+        self.aliases = aliases
+        self.keys = sorted(set(self.values) | set(aliases))
+        self.folded = {}
+
+    @staticmethod
+    def prefixed(items, prefix):
+        # '\xff' never shows up in utf-8, so it sorts after anything
+        # that starts with prefix.
+        return items[bisect.bisect_left(items, prefix):bisect.bisect_left(items, prefix + '\xff')]
+
+    def key(self, name):
+        return self.aliases.get(name, name)
+
+    def complete_key(self, prefix):
+        return self.prefixed(self.keys, prefix)
+
+    def complete_value(self, key, prefix):
+        return self.prefixed(self.values.get(self.key(key), []), prefix)
+
+    def has(self, key, value):
+        """ Whether any host has value for key. Like salt's I@ matcher,
+            case doesn't matter. """
+        key = self.key(key)
+        values = self.values.get(key)
+        if not values or any(c in value for c in '*?['):
+            return True
+        i = bisect.bisect_left(values, value)
+        if i < len(values) and values[i] == value:
+            return True
+        if key not in self.folded:
+            self.folded[key] = set(v.lower() for v in values)
+        return value.lower() in self.folded[key]
+
+    def suggest(self, key, value, limit=2000):
+        """ Values close to a misspelled one. With too many values to
+            compare them all, only the ones sharing the longest prefix
+            any of them has with it are, and never more than limit. """
+        values = self.values.get(self.key(key), [])
+        for n in xrange(len(value), 0, -1):
+            if len(values) <= limit:
+                break
+            candidates = self.prefixed(values, value[:n])
+            if candidates:
+                values = candidates
+                break
+        return difflib.get_close_matches(value, values[:limit], 3)
+
+def _to_str(data):
+    """ json hands back unicode everywhere, salt hands us str. """
+    if isinstance(data, dict):
+        return dict((_to_str(k), _to_str(v)) for k, v in data.items())
+    if isinstance(data, list):
+        return [_to_str(v) for v in data]
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    return data
+
+class DiskCache(object):
+    """ Small JSON cache on disk. Every entry carries the format
+        version and the time it was stored, so a cache written by an
+        older fssh is simply ignored and callers can decide what stale
+        means to them. Writes go to a temp file and get renamed into
+        place, so a reader never sees half an entry. """
+
+    version = 1
+
+    def __init__(self, path, ttl):
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+
+    def _file(self, name):
+        return os.path.join(self.path, "{0}.json".format(name))
+
+    def load(self, name):
+        """ Returns (data, age in seconds), or (None, None) if there
+            is no usable entry. """
+        try:
+            with open(self._file(name)) as fd:
+                entry = json.load(fd)
+        except (OSError, IOError, ValueError):
+            return None, None
+        if not isinstance(entry, dict) or entry.get('version') != self.version:
+            return None, None
+        return _to_str(entry.get('data')), time.time() - entry.get('stored', 0)
+
+    def store(self, name, data):
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path, 0700)
+            tmp = "{0}.{1}.tmp".format(self._file(name), os.getpid())
+            with open(tmp, 'w') as fd:
+                json.dump({'version': self.version, 'stored': time.time(), 'data': data}, fd)
+            os.rename(tmp, self._file(name))
+        except (OSError, IOError) as e:
+            print >>sys.stderr, "Unable to write cache {0}: {1}".format(self._file(name), e)
+
+    def is_fresh(self, age):
+        return age is not None and age < self.ttl
+
+def qualify_jid(jid, name):
+    """ Jids from different masters can collide, so with more than one
+        master they're tagged with the master's name: jid@name. """
+    return name and "{0}@{1}".format(jid, name) or jid
+
+class Master(object):
+    """ One salt master and the clients that talk to it. It only gets a
+        name when there's a [masters] section. config is the master's
+        config file, or the directory holding it like salt's -c. """
+
+    def __init__(self, name, config):
+        if os.path.isdir(config):
+            config = os.path.join(config, 'master')
+        self.name = name
+        self.config = config
+        self._opts = self._client = self._runner = None
+
+    # Reading the master config and connecting to it only happens once
+    # something actually asks the master for something.
+    @property
+    def opts(self):
+        if self._opts is None:
+            self._opts = load_salt().config.master_config(self.config)
+        return self._opts
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self.new_client()
+        return self._client
+
+    @property
+    def runner(self):
+        if self._runner is None:
+            self._runner = self.new_runner()
+        return self._runner
+
+    def new_client(self):
+        return load_salt().client.LocalClient(self.config)
+
+    def new_runner(self):
+        return load_salt().runner.RunnerClient(self.opts)
+
+class EventSource(object):
+    """ Job returns, read straight off the event bus of every master as
+        the minions send them. Anything with the same get_return() can
+        stand in for it, which is how the master gets faked out. """
+
+    def __init__(self, masters):
+        # load_salt() first, for its root check.
+        salt = load_salt()
+        import salt.utils.event
+        self.buses = [(master.name, salt.utils.event.get_master_event(master.opts, master.opts['sock_dir'], listen=True))
+                      for master in masters]
+
+    def get_return(self, jids, wait):
+        """ Returns the next (jid, minion, data) for any of jids (or
+            any job at all if jids is None), or None if nothing showed up
+            within wait seconds. """
+        deadline = time.time() + wait
+        # With several buses to read, no one bus gets to block for long.
+        step = len(self.buses) > 1 and 0.05 or wait
+        while True:
+            for name, bus in self.buses:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                event = bus.get_event(wait=min(remaining, step), tag='salt/job/', full=True)
+                if not event:
+                    continue
+                # salt/job/<jid>/ret/<minion>
+                tag = event.get('tag', '').split('/')
+                if len(tag) >= 5 and tag[3] == 'ret':
+                    jid = qualify_jid(tag[2], name)
+                    if jids is None or jid in jids:
+                        return jid, event['data'].get('id', tag[4]), event['data']
+
+def print_return(minion, ret, retcode=0, counter=''):
+    """ Shell output gets printed as is, indented under the minion,
+        anything else gets dumped as json so it's at least readable. """
+    if retcode:
+        header = wrap("{0}{1}: (retcode {2})".format(counter, minion, retcode), attr.bright, fgcolor.red)
+    else:
+        header = wrap("{0}{1}:".format(counter, minion), attr.bright, fgcolor.green)
+    print header
+    if not isinstance(ret, basestring):
+        ret = json.dumps(ret, indent=4, sort_keys=True, default=str)
+    for line in ret.splitlines():
+        print "    {0}".format(line)
+
+class HostRanges(object):
+    """ Collects hostnames and prints them folded into ranges, like
+        web[0001-0040,0042].example.com. The last run of digits in the
+        short hostname is the one that gets folded, and only numbers of
+        the same width end up in the same range. """
+
+    host_re = re.compile(r'^([^.]*?)(\d+)([^.\d]*(?:\..*)?)$')
+
+    def __init__(self):
+        # (prefix, suffix, width): ([starts], [ends]) of the ranges so
+        # far, sorted and merged as numbers come in, so a run of a
+        # thousand hosts is two ints rather than a thousand.
+        self.numbered = {}
+        self.other = set()
+        self.count = 0
+
+    def add(self, host):
+        self.count += 1
+        match = self.host_re.match(host)
+        if not match:
+            self.other.add(host)
+            return
+        prefix, digits, suffix = match.groups()
+        starts, ends = self.numbered.setdefault((prefix, suffix, len(digits)), ([], []))
+        number = int(digits)
+        i = bisect.bisect_right(starts, number) - 1
+        if i >= 0 and number <= ends[i]:
+            return
+        left = i >= 0 and ends[i] == number - 1
+        right = i + 1 < len(starts) and starts[i + 1] == number + 1
+        if left and right:
+            ends[i] = ends.pop(i + 1)
+            del starts[i + 1]
+        elif left:
+            ends[i] = number
+        elif right:
+            starts[i + 1] = number
+        else:
+            starts.insert(i + 1, number)
+            ends.insert(i + 1, number)
+
+    def __str__(self):
+        hosts = list(self.other)
+        for (prefix, suffix, width), (starts, ends) in self.numbered.items():
+            ranges = []
+            for start, end in zip(starts, ends):
+                if start == end:
+                    ranges.append("{0:0{1}d}".format(start, width))
+                else:
+                    ranges.append("{0:0{2}d}-{1:0{2}d}".format(start, end, width))
+            if len(starts) == 1 and starts[0] == ends[0]:
+                hosts.append("{0}{1}{2}".format(prefix, ranges[0], suffix))
+            else:
+                hosts.append("{0}[{1}]{2}".format(prefix, ",".join(ranges), suffix))
+        return ",".join(sorted(hosts))
+
+class PlainOutput(object):
+    """ Print every return as it comes in. """
+
+    def add(self, minion, ret, retcode=0, counter=''):
+        print_return(minion, ret, retcode, counter)
+
+    def finish(self):
+        pass
+
+class GroupedOutput(object):
+    """ Like dshbak -c: minions with identical output (and retcode)
+        are printed once, under their folded host ranges. Only one copy
+        of each distinct output is kept, however many hosts send it.
+        The biggest groups come first, so the odd ones out end up right
+        above the prompt. """
+
+    def __init__(self):
+        self.groups = {}
+        self.progress = sys.stdout.isatty()
+
+    def add(self, minion, ret, retcode=0, counter=''):
+        if not isinstance(ret, basestring):
+            ret = json.dumps(ret, indent=4, sort_keys=True, default=str)
+        key = hashlib.md5("{0}\0{1}".format(retcode, ret)).digest()
+        if key not in self.groups:
+            self.groups[key] = (ret, retcode, HostRanges())
+        self.groups[key][2].add(minion)
+        if self.progress and counter:
+            sys.stdout.write("\r{0}{1} distinct outputs ".format(counter, len(self.groups)))
+            sys.stdout.flush()
+
+    def finish(self):
+        if self.progress:
+            sys.stdout.write("\r")
+        for ret, retcode, hosts in sorted(self.groups.values(), key=lambda g: -g[2].count):
+            title = " {0} ({1} host{2}{3}) ".format(hosts, hosts.count, hosts.count > 1 and 's' or '',
+                                                    retcode and ", retcode {0}".format(retcode) or '')
+            if retcode:
+                print wrap(title.center(get_columns(), '-'), attr.bright, fgcolor.red)
+            else:
+                _padder(title)
+            for line in ret.splitlines():
+                print "    {0}".format(line)
+        self.groups = {}
+
+class ReducedOutput(object):
+    """ '| stats $N' and '| hist $N': pull field N (awk style, $0 is
+        the whole line) out of every line of every return, keep the ones
+        that are numbers in a flat array and print a summary instead of
+        the returns, naming the minions at either end. """
+
+    outliers = 5
+    bins = 10
+
+    def __init__(self, op, field):
+        self.op = op
+        self.field = field
+        self.values = array.array('d')
+        self.minions = []
+        self.unparsed = []
+
+    def add(self, minion, ret, retcode=0, counter=''):
+        if not isinstance(ret, basestring):
+            ret = json.dumps(ret, sort_keys=True, default=str)
+        found = False
+        for line in ret.splitlines():
+            fields = self.field and line.split() or [line.strip()]
+            if len(fields) < max(self.field, 1):
+                continue
+            try:
+                value = float(fields[max(self.field, 1) - 1].rstrip('%'))
+            except ValueError:
+                continue
+            self.values.append(value)
+            self.minions.append(minion)
+            found = True
+        if not found:
+            self.unparsed.append(minion)
+
+    def percentile(self, order, pct):
+        return self.values[order[min(len(order) - 1, int(len(order) * pct / 100.0))]]
+
+    def finish(self):
+        values = self.values
+        count = len(values)
+        _padder(" {0} ${1} over {2} values ".format(self.op, self.field, count))
+        if self.unparsed:
+            hosts = HostRanges()
+            for minion in self.unparsed:
+                hosts.add(minion)
+            print "No number in field ${0} from {1} minions: {2}".format(self.field, len(self.unparsed), hosts)
+        if not count:
+            return
+        order = sorted(xrange(count), key=values.__getitem__)
+        total = sum(values)
+        mean = total / count
+        stddev = (sum((v - mean) ** 2 for v in values) / count) ** 0.5
+        if self.op == 'stats':
+            print "count {0}  sum {1:g}  mean {2:g}  stddev {3:g}".format(count, total, mean, stddev)
+            print "min {0:g}  p50 {1:g}  p90 {2:g}  p99 {3:g}  max {4:g}".format(
+                values[order[0]], self.percentile(order, 50), self.percentile(order, 90),
+                self.percentile(order, 99), values[order[-1]])
+        else:
+            low, high = values[order[0]], values[order[-1]]
+            width = (high - low) / self.bins or 1
+            counts = [0] * self.bins
+            for value in values:
+                counts[min(self.bins - 1, int((value - low) / width))] += 1
+            scale = max(1, get_columns() - 32) / float(max(counts))
+            for i, n in enumerate(counts):
+                print "{0:>12g} - {1:<12g} {2:>6} {3}".format(low + i * width, low + (i + 1) * width, n, '#' * int(n * scale))
+        print "Lowest:  {0}".format(", ".join("{0} ({1:g})".format(self.minions[i], values[i]) for i in order[:self.outliers]))
+        print "Highest: {0}".format(", ".join("{0} ({1:g})".format(self.minions[i], values[i]) for i in reversed(order[-self.outliers:])))
+
+class OutputWriter(object):
+    """ Writes every minion's return to files of its own, under a
+        directory per job: minion.out, minion.err (only if there's any
+        stderr) and minion.rc. Returns are held in memory and written
+        out a batch at a time, once buffer_size bytes are waiting or
+        it's been a second since the last batch. Every file is written
+        under a temporary name, closed straight away, and renamed into
+        place once the minion's return is complete, so there's never
+        more than one file open and nothing half written ever shows up
+        under the real name. Used from the tracker thread as well. """
+
+    interval = 1
+
+    def __init__(self, directory, buffer_size):
+        self.directory = directory
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_bytes = 0
+        self.written = set()
+        self.flushed = time.time()
+
+    def add(self, job, minion, ret, retcode=0):
+        """ Queue up a return of job (the first jid of the job). Returns
+            False if that minion's return was already written. """
+        if isinstance(ret, dict) and 'stdout' in ret:
+            out, err = ret.get('stdout') or '', ret.get('stderr') or ''
+            retcode = ret.get('retcode', retcode)
+        else:
+            out, err = ret, ''
+        if not isinstance(out, basestring):
+            out = json.dumps(out, indent=4, sort_keys=True, default=str)
+        # Salt strips the last newline off shell output.
+        files = [('out', out and out.rstrip('\n') + '\n'), ('err', err and err.rstrip('\n') + '\n'),
+                 ('rc', "{0}\n".format(retcode or 0))]
+        files = [(ext, isinstance(data, unicode) and data.encode('utf-8') or data) for ext, data in files]
+        with self.lock:
+            if (job, minion) in self.written:
+                return False
+            self.written.add((job, minion))
+            self.pending.append((job, minion, files))
+            self.pending_bytes += sum(len(data) for ext, data in files)
+            if self.pending_bytes >= self.buffer_size or time.time() - self.flushed >= self.interval:
+                self.flush(locked=True)
+        return True
+
+    def flush(self, locked=False):
+        if not locked:
+            with self.lock:
+                return self.flush(locked=True)
+        pending, self.pending, self.pending_bytes = self.pending, [], 0
+        self.flushed = time.time()
+        for job, minion, files in pending:
+            path = self.path(job)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            name = minion.replace(os.sep, '_')
+            for ext, data in files:
+                if ext == 'err' and not data:
+                    continue
+                final = os.path.join(path, "{0}.{1}".format(name, ext))
+                temp = os.path.join(path, ".{0}.{1}.tmp".format(name, ext))
+                with open(temp, 'wb') as fd:
+                    fd.write(data)
+                os.rename(temp, final)
+
+    def path(self, job):
+        return os.path.join(self.directory, job.replace(os.sep, '_'))
+
+class FileOutput(object):
+    """ Hand returns to an OutputWriter instead of printing them, and
+        only say where they went. """
+
+    def __init__(self, writer, job):
+        self.writer = writer
+        self.job = job
+        self.count = 0
+        self.failed = 0
+        self.progress = sys.stdout.isatty()
+
+    def add(self, minion, ret, retcode=0, counter=''):
+        self.writer.add(self.job, minion, ret, retcode)
+        self.count += 1
+        if retcode:
+            self.failed += 1
+        if self.progress and counter:
+            sys.stdout.write("\r{0}written ".format(counter))
+            sys.stdout.flush()
+
+    def finish(self):
+        self.writer.flush()
+        if self.progress:
+            sys.stdout.write("\r")
+        print "Output of {0} minions ({1} with a non-zero retcode) is in {2}/".format(
+            self.count, self.failed, self.writer.path(self.job))
+        self.count = self.failed = 0
+
+def parse_module_call(line):
+    """ 'module.function(arg, key=value)' -> (function, args, kwargs).
+        Arguments have to be python literals. Returns None for anything
+        that isn't a call like that, and raises ValueError for a call
+        with arguments that can't be used. """
+    if not re.match(r'^[A-Za-z_]\w*\.[A-Za-z_]\w*\s*\(.*\)$', line):
+        return None
+    try:
+        call = ast.parse(line, mode='eval').body
+    except SyntaxError:
+        return None
+    if not isinstance(call, ast.Call) or getattr(call, 'starargs', None) or getattr(call, 'kwargs', None):
+        return None
+    args = [ast.literal_eval(arg) for arg in call.args]
+    kwargs = dict((kw.arg, ast.literal_eval(kw.value)) for kw in call.keywords)
+    return line.split('(', 1)[0].strip(), args, kwargs
+
+def cli_args(args, kwargs=None):
+    """ The arguments the way the salt CLI wants them. """
+    words = [isinstance(a, basestring) and a or json.dumps(a) for a in args]
+    words += ["{0}={1}".format(k, isinstance(v, basestring) and v or json.dumps(v))
+              for k, v in sorted((kwargs or {}).items())]
+    return " ".join(pipes.quote(w) for w in words)
+
+def parse_percent(spec, total):
+    """ '10%' of total, or just the number. Never less than 1. """
+    if spec.endswith('%'):
+        return max(1, int(total * float(spec[:-1]) / 100))
+    return max(1, int(spec))
+
+def return_failed(data):
+    """ A return event failed if the function said so or cmd.shell
+        left a non-zero retcode behind. """
+    if not isinstance(data, dict):
+        return False
+    return data.get('success') is False or bool(data.get('retcode'))
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _clock_gettime():
+    try:
+        clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or 'libc.so.6').clock_gettime
+    except (OSError, AttributeError):
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    return clock_gettime
+
+_clock = _clock_gettime()
+
+def monotonic():
+    """ Python 2 has no time.monotonic(), so CLOCK_MONOTONIC straight
+        from libc, and the wall clock where that can't be had. """
+    if _clock is None:
+        return time.time()
+    now = _timespec()
+    _clock(1, ctypes.byref(now))
+    return now.tv_sec + now.tv_nsec * 1e-9
+
+class Submission(object):
+    def __init__(self, job, minions, work):
+        self.job = job
+        self.minions = minions
+        self.work = work
+        self.after = []
+        self.messages = []
+        self.done = threading.Event()
+
+class Pipeline(object):
+    """ Publishes jobs from a few worker threads, so a script goes on to
+        its next line without waiting on the master. A job is only
+        published after every earlier one that might target the same
+        minions, so those still reach the minions in script order. Which
+        minions a job targets is None when there's no pillar index to
+        tell, and then it's taken to overlap with everything. """
+
+    def __init__(self, threads):
+        self.queue = Queue.Queue()
+        self.pending = []
+        for i in xrange(threads):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+
+    def add(self, job, minions, work):
+        submission = Submission(job, minions, work)
+        submission.after = [earlier for earlier in self.pending if not earlier.done.is_set() and (
+            minions is None or earlier.minions is None or minions & earlier.minions)]
+        self.pending.append(submission)
+        # Submissions only ever wait on earlier ones, which the queue
+        # hands out first, so the workers can't deadlock.
+        self.queue.put(submission)
+
+    def work(self):
+        while True:
+            submission = self.queue.get()
+            for earlier in submission.after:
+                earlier.done.wait()
+            try:
+                submission.messages = submission.work()
+            except Exception as e:
+                submission.job.state = 'failed'
+                submission.messages = ["There was an error executing your job: {0}".format(e)]
+            submission.done.set()
+
+    def drain(self):
+        """ Wait for every submission so far, and hand them back in
+            the order they were added. """
+        drained, self.pending = self.pending, []
+        for submission in drained:
+            while not submission.done.is_set():
+                submission.done.wait(0.1)
+        return drained
+
+class Timer(object):
+    """ When each phase of one command line ended, in seconds from when
+        the line was read. If it submitted a job, when the first and the
+        last minion returned are counted as phases too. """
+
+    def __init__(self, line, timings):
+        self.line = line
+        self.started = time.time()
+        self.start = monotonic()
+        self.marks = []
+        self.job = None
+        self.timings = timings
+
+    def mark(self, phase):
+        if not self.marks:
+            self.timings.append(self)
+        self.marks.append((phase, monotonic() - self.start))
+
+    def phases(self):
+        """ [(phase, seconds in, seconds since the phase before)] """
+        marks = list(self.marks)
+        job = self.job
+        if job and job.first_return is not None:
+            marks += [('first return', job.first_return - self.start), ('last return', job.last_return - self.start)]
+        phases, previous = [], 0
+        for phase, at in sorted(marks, key=lambda mark: mark[1]):
+            phases.append((phase, at, at - previous))
+            previous = at
+        return phases
+
+    def summary(self):
+        return ", ".join("{0} {1:.1f}ms".format(phase, took * 1000) for phase, at, took in self.phases())
+
+    def record(self):
+        """ What goes in the stats file, times in milliseconds. """
+        record = {'time': self.started, 'command': self.line,
+                  'phases': dict((phase, round(at * 1000, 3)) for phase, at, took in self.phases())}
+        job = self.job
+        if job:
+            record.update({'jids': job.jids, 'state': job.state, 'returned': len(job.returns),
+                           'expected': job.expected is not None and len(job.expected) or None,
+                           'failed': job.failed(), 'retries': job.retries})
+        return record
+
+class Job(object):
+    """ One command submitted from this session, and every jid it
+        took to run it (host lists and batches can take several). """
+
+    def __init__(self, target, command):
+        self.jids = []
+        self.target = target
+        self.command = command
+        self.state = 'running'
+        self.expected = None
+        self.returns = {}
+        self.started = self.active = time.time()
+        self.call = None
+        self.retries = 0
+        self.sent = {}
+        self.timer = None
+        self.first_return = self.last_return = None
+
+    def add_return(self, minion, data):
+        self.returns[minion] = data
+        self.active = time.time()
+        self.last_return = monotonic()
+        if self.first_return is None:
+            self.first_return = self.last_return
+        if self.expected is not None and self.expected <= set(self.returns):
+            self.state = 'done'
+
+    def failed(self):
+        return len([d for d in self.returns.values() if return_failed(d)])
+
+    def missing(self):
+        """ Targeted minions that haven't returned, None if we don't
+            know yet which minions were targeted. """
+        if self.expected is None:
+            return None
+        return sorted(self.expected - set(self.returns))
+
+class JobTable(object):
+    """ Every job submitted this session. Returns get recorded by the
+        tracker thread, so everything here goes through the lock. Returns
+        for a jid we don't know (yet) are held on to for a little while,
+        since the event can beat cmd_async handing us the jid. """
+
+    orphan_ttl = 30
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = []
+        self.by_jid = {}
+        self.orphans = {}
+        self.finished = []
+        self.unlogged = []
+        self.forgotten = set()
+
+    def add(self, job):
+        with self.lock:
+            self.jobs.append(job)
+
+    def add_jid(self, job, jid):
+        with self.lock:
+            job.jids.append(jid)
+            self.by_jid[jid] = job
+            orphans = self.orphans.pop(jid, (0, {}))[1]
+            for minion, data in orphans.items():
+                job.add_return(minion, data)
+            return orphans
+
+    def find(self, jid):
+        """ A jid without @master finds it on any master. """
+        with self.lock:
+            if jid in self.by_jid or '@' in jid:
+                return self.by_jid.get(jid)
+            for known, job in self.by_jid.items():
+                if known.split('@')[0] == jid:
+                    return job
+
+    def outstanding(self):
+        with self.lock:
+            return [job for job in self.jobs if job.state == 'running']
+
+    def record(self, jid, minion, data):
+        with self.lock:
+            job = self.by_jid.get(jid)
+            if job is None:
+                self.orphans.setdefault(jid, (time.time(), {}))[1][minion] = data
+                for old in [j for j, (t, r) in self.orphans.items() if time.time() - t > self.orphan_ttl]:
+                    del self.orphans[old]
+                return None
+            running = job.state == 'running'
+            job.add_return(minion, data)
+            if running and job.state != 'running':
+                self.finish(job)
+            return job
+
+    def set_expected(self, job, minions, returns):
+        """ The master's job cache can lag a moment behind the publish,
+            so an empty minion list just means ask again later. """
+        if not minions:
+            return
+        with self.lock:
+            running = job.state == 'running'
+            job.expected = set(job.expected or ()) | set(minions)
+            for minion, data in returns.items():
+                if minion not in job.returns:
+                    job.add_return(minion, data)
+            if running and job.expected <= set(job.returns):
+                job.state = 'done'
+            if running and job.state != 'running':
+                self.finish(job)
+
+    def resume(self, job):
+        """ A job that's been re-submitted to its stragglers is running
+            again, unless they all got their returns in already. """
+        with self.lock:
+            job.state = 'running'
+            job.active = time.time()
+            job.retries += 1
+            if job.expected <= set(job.returns):
+                job.state = 'done'
+                self.finish(job)
+
+    def expire(self, timeout):
+        with self.lock:
+            for job in self.jobs:
+                if job.state == 'running' and time.time() - job.active > timeout:
+                    job.state = 'timed out'
+                    self.finish(job)
+
+    def finish(self, job):
+        """ Called with the lock held when a job stops running. """
+        self.finished.append(job)
+        self.unlogged.append(job)
+
+    def pop_finished(self):
+        with self.lock:
+            finished, self.finished = self.finished, []
+            return finished
+
+    def pop_unlogged(self):
+        with self.lock:
+            unlogged, self.unlogged = self.unlogged, []
+            return unlogged
+
+    def forget(self, jobs=()):
+        """ Drop jobs nobody is going to ask about again, returns and
+            all, as soon as they aren't running any more. Ones still
+            running are dropped by a later call. """
+        with self.lock:
+            self.forgotten.update(jobs)
+            done = set(job for job in self.forgotten if job.state != 'running')
+            if not done:
+                return
+            self.forgotten -= done
+            self.jobs = [job for job in self.jobs if job not in done]
+            self.finished = [job for job in self.finished if job not in done]
+            for job in done:
+                for jid in job.jids:
+                    self.by_jid.pop(jid, None)
+
+def _regexp(pattern, text):
+    return text is not None and re.search(pattern, text) is not None
+
+class ResultStore(object):
+    """ Job returns kept in a local sqlite database, so looking a job
+        up again (or searching across jobs) doesn't mean pulling every
+        return out of the master's job cache again. A job is only served
+        from here once every minion it was sent to has returned. """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            jid TEXT PRIMARY KEY, stored REAL, complete INTEGER DEFAULT 0);
+        CREATE TABLE IF NOT EXISTS returns (
+            jid TEXT, minion TEXT, retcode INTEGER, output TEXT, structured INTEGER,
+            PRIMARY KEY (jid, minion));
+        CREATE TABLE IF NOT EXISTS expected (
+            jid TEXT, minion TEXT, PRIMARY KEY (jid, minion));
+        CREATE INDEX IF NOT EXISTS returns_minion ON returns (minion);
+        CREATE INDEX IF NOT EXISTS returns_retcode ON returns (jid, retcode);
+    """
+
+    def __init__(self, path, keep_days, busy_timeout=10):
+        # Other fssh runs (cron, --server, other admins) share the file.
+        # WAL lets them read while one writes, every write is committed
+        # as soon as it's done, and a writer waits busy_timeout seconds
+        # for another one before giving up.
+        if path != ':memory:':
+            path = os.path.expanduser(path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), 0700)
+        self.lock = threading.Lock()
+        # Jobs with returns that couldn't be saved, and the ones (and
+        # how many writes) not committed yet.
+        self.lost = set()
+        self.pending = set()
+        self.rows = 0
+        self.db = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.create_function('REGEXP', 2, _regexp)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.executescript(self.schema)
+        old = time.time() - keep_days * 86400
+        try:
+            self.db.execute('DELETE FROM returns WHERE jid IN (SELECT jid FROM jobs WHERE stored < ?)', (old,))
+            self.db.execute('DELETE FROM expected WHERE jid IN (SELECT jid FROM jobs WHERE stored < ?)', (old,))
+            self.db.execute('DELETE FROM jobs WHERE stored < ?', (old,))
+            self.db.commit()
+        except sqlite3.OperationalError:
+            # Someone else is busy with it, the next run prunes.
+            self.db.rollback()
+
+    def write(self, jid, statements, commit=True):
+        """ Run [(sql, args or [args, ...])] for jid, committed along with
+            anything left pending. Returns off the event bus come in too
+            fast to commit one by one, so those are left pending (commit
+            False) until the next flush(), or until there are a thousand
+            of them. If the store stays locked it's all rolled back, and
+            the jobs involved won't be called complete, so looking them
+            up asks the master again. """
+        with self.lock:
+            try:
+                self.pending.add(jid)
+                self.db.execute('INSERT OR IGNORE INTO jobs (jid, stored) VALUES (?, ?)', (jid, time.time()))
+                for sql, args in statements:
+                    if isinstance(args, list):
+                        self.db.executemany(sql, args)
+                    else:
+                        self.db.execute(sql, args)
+                self.rows += 1
+                if commit or self.rows >= 1000:
+                    self.commit()
+            except sqlite3.OperationalError as e:
+                self.rollback(e)
+
+    def commit(self):
+        self.db.commit()
+        self.pending = set()
+        self.rows = 0
+
+    def rollback(self, e):
+        self.db.rollback()
+        print >>sys.stderr, wrap("Couldn't save returns of {0}: {1}".format(", ".join(sorted(self.pending)), e),
+                                 attr.bright, fgcolor.yellow)
+        self.lost.update(self.pending)
+        self.pending = set()
+        self.rows = 0
+
+    def row(self, jid, minion, data):
+        if not isinstance(data, dict) or 'return' not in data:
+            data = {'return': data}
+        ret = data['return']
+        structured = not isinstance(ret, basestring)
+        if structured:
+            ret = json.dumps(ret, sort_keys=True, default=str)
+        retcode = data.get('retcode')
+        if retcode is None and data.get('success') is False:
+            retcode = 1
+        return (jid, minion, retcode, ret, int(structured))
+
+    def add(self, jid, minion, data, commit=True):
+        self.add_many(jid, {minion: data}, commit)
+
+    def add_many(self, jid, returns, commit=True):
+        self.write(jid, [('INSERT OR REPLACE INTO returns VALUES (?, ?, ?, ?, ?)',
+                          [self.row(jid, minion, data) for minion, data in returns.items()])], commit)
+
+    def flush(self):
+        """ Commit whatever add() left pending. """
+        with self.lock:
+            if not self.pending:
+                return
+            try:
+                self.commit()
+            except sqlite3.OperationalError as e:
+                self.rollback(e)
+
+    def set_expected(self, jid, minions):
+        """ Remember which minions a job was sent to. """
+        self.write(jid, [('INSERT OR IGNORE INTO expected VALUES (?, ?)', [(jid, m) for m in minions])])
+
+    def mark_complete(self, jid):
+        if jid not in self.lost:
+            self.write(jid, [('UPDATE jobs SET complete = 1 WHERE jid = ?', (jid,))])
+
+    def is_complete(self, jid):
+        with self.lock:
+            row = self.db.execute('SELECT complete FROM jobs WHERE jid = ?', (jid,)).fetchone()
+        return bool(row and row[0])
+
+    def returns(self, jid):
+        """ {minion: (return, retcode)} for a job. """
+        return dict((minion, (ret, retcode)) for minion, ret, retcode in self.iter_returns([jid]))
+
+    def iter_returns(self, jids, chunk=1000):
+        """ (minion, return, retcode) for every minion that returned to
+            any of jids, in minion order, read a chunk at a time instead
+            of all at once. A minion in several of them gets its return
+            from the last one. """
+        if not jids:
+            return
+        order = dict((jid, i) for i, jid in enumerate(jids))
+        # More rows than any one minion can have, so a full chunk
+        # always has a minion past the one it might cut off.
+        limit = max(chunk, len(jids) + 1)
+        after = ''
+        while True:
+            with self.lock:
+                rows = self.db.execute('SELECT minion, jid, output, structured, retcode FROM returns'
+                                       ' WHERE jid IN ({0}) AND minion > ? ORDER BY minion LIMIT ?'.format(
+                                           ','.join('?' * len(jids))), list(jids) + [after, limit]).fetchall()
+            more = len(rows) == limit
+            if more:
+                rows = [row for row in rows if row[0] != rows[-1][0]]
+            for minion, group in itertools.groupby(rows, lambda row: row[0]):
+                minion, jid, output, structured, retcode = max(group, key=lambda row: order[row[1]])
+                yield minion, json.loads(output) if structured else output, retcode
+            if not more:
+                return
+            after = rows[-1][0]
+
+    def grep(self, pattern, jids):
+        with self.lock:
+            rows = self.db.execute('SELECT DISTINCT minion FROM returns WHERE jid IN ({0}) AND output REGEXP ?'
+                                   ' ORDER BY minion'.format(','.join('?' * len(jids))),
+                                   list(jids) + [pattern]).fetchall()
+        return [row[0] for row in rows]
+
+    def failed(self, jids):
+        """ Minions that failed in any of jids. """
+        with self.lock:
+            rows = self.db.execute('SELECT DISTINCT minion FROM returns WHERE jid IN ({0}) AND retcode != 0'
+                                   ' ORDER BY minion'.format(','.join('?' * len(jids))), jids).fetchall()
+        return [row[0] for row in rows]
+
+    def missing(self, jids):
+        """ Minions any of jids was sent to that none of them got a return from. """
+        marks = ','.join('?' * len(jids))
+        with self.lock:
+            rows = self.db.execute('SELECT DISTINCT minion FROM expected WHERE jid IN ({0}) AND minion NOT IN'
+                                   ' (SELECT minion FROM returns WHERE jid IN ({0})) ORDER BY minion'.format(marks),
+                                   list(jids) * 2).fetchall()
+        return [row[0] for row in rows]
+
+    def last(self, count):
+        with self.lock:
+            rows = self.db.execute('SELECT jid FROM jobs ORDER BY stored DESC, jid DESC LIMIT ?', (count,)).fetchall()
+        return [row[0] for row in rows]
+
 class SaltShell(object):
     def __init__(self, files, opts):
         self.user = opts.user
@@ -125,9 +1526,58 @@ class SaltShell(object):
         self.pillars = {}
         self.config_file = opts.config
         self.config = self.getConfig()
-        self.job = ''
-        self.salt = salt.client.LocalClient()
-        self.runner = salt.runner.RunnerClient(salt.config.master_config('/etc/salt/master'))
+        self.job = []
+        self.batch = None
+        self.group_output = self.get_option('group_output', 'off') == 'on'
+        self.reduction = None
+        self.writer = None
+        self.set_output_dir(opts.output_dir or self.get_option('output_dir'))
+        self.index = None
+        self.catalog = None
+        self.cache = DiskCache(self.get_option('cache_dir', cache_dir),
+                               int(self.get_option('pillar_ttl', 3600)))
+        self.masters = self.get_masters()
+        self.events = None
+        self.timer = None
+        self.timings = collections.deque(maxlen=100)
+        self.compiled = {}
+        self.local = threading.local()
+        self.pipeline = None
+        self.jobs = JobTable()
+        self.tracker = None
+        self._results = None
+
+    @property
+    def results(self):
+        """ The result store, only opened once there are results to keep
+            or look up. """
+        if self._results is None:
+            path = self.get_option('result_db', os.path.join(cache_dir, 'results.db'))
+            keep_days = float(self.get_option('result_keep_days', 7))
+            try:
+                self._results = ResultStore(path, keep_days, float(self.get_option('result_busy_timeout', 10)))
+            except sqlite3.OperationalError as e:
+                print >>sys.stderr, wrap("Can't open the result store {0}: {1}. Returns are only kept in memory "
+                                         "this session.".format(path, e), attr.bright, fgcolor.yellow)
+                self._results = ResultStore(':memory:', keep_days)
+            atexit.register(self._results.flush)
+        return self._results
+
+    def on_results(self, fun, *args):
+        """ fun(*args) for a lookup in the result store. If another
+            fssh keeps the store locked too long, it's run again against
+            a scratch store for just this lookup, which fetch_job fills
+            straight from the master. """
+        try:
+            return fun(*args)
+        except sqlite3.OperationalError as e:
+            print >>sys.stderr, wrap("The result store is busy ({0}), asking the master instead.".format(e),
+                                     attr.bright, fgcolor.yellow)
+            results, self._results = self._results, ResultStore(':memory:', 0)
+            try:
+                return fun(*args)
+            finally:
+                self._results = results
 
     def getConfig(self):
         if os.path.isfile(self.config_file):
@@ -137,6 +1587,67 @@ class SaltShell(object):
         else:
             return False
 
+    def get_option(self, name, default=None):
+        """ Look up a setting in the [main] section of the config. """
+        if self.config and self.config.has_option('main', name):
+            return self.config.get('main', name)
+        return default
+
+    @property
+    def salt(self):
+        """ The first master is the one pillars are read from. """
+        return self.masters[0].client
+
+    def get_masters(self):
+        """ Every master in the [masters] section (name = config dir),
+            or just the local one. """
+        if self.config and self.config.has_section('masters') and self.config.items('masters'):
+            return [Master(name, os.path.expanduser(config)) for name, config in self.config.items('masters')]
+        return [Master(None, '/etc/salt/master')]
+
+    def on_masters(self, fun):
+        """ Call fun(master) for every master at once, each in its own
+            thread, so a global job takes as long as the slowest master
+            instead of all of them together. Returns [(master, result)];
+            a master that raised is reported and left out. """
+        if len(self.masters) == 1:
+            return [(self.masters[0], fun(self.masters[0]))]
+        results, errors = {}, {}
+
+        def call(master):
+            try:
+                results[master] = fun(master)
+            except Exception as e:
+                errors[master] = e
+
+        threads = [threading.Thread(target=call, args=(master,)) for master in self.masters]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.1)
+        for master in self.masters:
+            if master in errors:
+                print >>sys.stderr, wrap("Master {0}: {1}".format(master.name, errors[master]), attr.bright, fgcolor.red)
+        return [(master, results[master]) for master in self.masters if master in results]
+
+    def split_jid(self, jid):
+        """ jid@name -> (jid, that master). The master is None if
+            there's no such master. """
+        jid, _, name = jid.partition('@')
+        for master in self.masters:
+            if master.name == (name or None):
+                return jid, master
+        return jid, None
+
+    def expand_jids(self, jids):
+        """ A jid typed without @master could be from any of them. """
+        if len(self.masters) == 1:
+            return jids
+        return [qualified for jid in jids for qualified in
+                ('@' in jid and [jid] or [qualify_jid(jid, master.name) for master in self.masters])]
+
     def printConfig(self):
         if self.config:
             print "Config loaded from {0}:\n".format(self.config_file)
@@ -159,34 +1670,48 @@ class SaltShell(object):
             self.printConfig()
 
         if opts.use_pillars:
-            """ Load pillars for myself to get a list to display
-                as possible options. I copy the data to self to
-                preserve types and such, and maybe the example
-                data being available will be useful later. """
-            print "Loading available pillars.",
-            sys.stdout.flush()
-            pillars = self.salt.cmd(self.fqdn, 'pillar.raw', [''])
-            pillars = pillars[self.fqdn]
-            self.pillars = dict(pillars)
-            for pillar in pillars:
-                if re.match('^graindiff.*$', pillar):
-                    del self.pillars[pillar]
-            print "   Done!"
+            self.load_pillars()
             if opts.verbose:
                 _padder(" Available pillars and their data types: ")
                 for pillar in self.pillars:
                     print "{0} {1}".format(type(self.pillars[pillar]), pillar)
                 _padder(" Keep in mind that only str has really been tested. ")
+            self.load_catalog()
+
+        if do_readline:
+            readline.set_completer(self.complete)
+            readline.set_completer_delims(' \t')
+            if 'libedit' in (readline.__doc__ or ''):
+                readline.parse_and_bind('bind ^I rl_complete')
+            else:
+                readline.parse_and_bind('tab: complete')
+
+        # Scripts are read and checked in full before any of them runs,
+        # so a typo near the end doesn't leave the start half done.
+        scripts = {}
+        errors = []
+        for name, fd, line in self.files:
+            if not fd.isatty():
+                scripts[fd] = self.load_script(name, fd, errors)
+        if errors:
+            for error in errors:
+                print >>sys.stderr, wrap(error, attr.bright, fgcolor.red)
+            print >>sys.stderr, "Not running anything, {0} problems found.".format(len(errors))
+            sys.exit(1)
 
         while self.files:
             self.curfile, self.curfd, self.curline = self.files[0]
             self.files = self.files[1:]
             try:
+                if self.curfd in scripts:
+                    self.run_script(scripts.pop(self.curfd))
+                    continue
                 while True:
                     line = self.get_input()
                     if not line:
                         break
                     self.parse_and_run(line)
+                    self.finish_timer()
 
             except:
                 if do_readline:
@@ -196,11 +1721,386 @@ class SaltShell(object):
         if do_readline:
             readline.write_history_file(os.path.expanduser(history_file))
 
+    def load_script(self, name, fd, errors, depth=0):
+        """ Every line of a script as (where, line), with '.' includes
+            read in where they are. Whatever is wrong with a line goes on
+            errors. """
+        lines = []
+        for number, line in enumerate(fd, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            where = "{0}:{1}".format(name, number)
+            if line.startswith('.'):
+                path = line[1:].strip()
+                if depth >= 20:
+                    errors.append("{0}: includes nested too deep at {1}".format(where, path))
+                    continue
+                try:
+                    with open(path) as include:
+                        lines += self.load_script(path, include, errors, depth + 1)
+                except (OSError, IOError) as e:
+                    errors.append("{0}: can't source {1}: {2}".format(where, path, e))
+                continue
+            kind, problem = self.classify(line)
+            if problem:
+                errors.append("{0}: {1}".format(where, problem))
+            lines.append((where, line))
+        return lines
+
+    def classify(self, line):
+        """ What kind of line this is (see commands), and what's wrong
+            with it if anything, without running it. """
+        reduction = reduction_re.match(line)
+        if reduction:
+            line = reduction.group(1)
+        name, kind, offline = find_command(line)
+        if name == 'put':
+            args = line.split()[1:]
+            if len(args) != 2:
+                return kind, "Usage: put <local file> <remote path>"
+            if not os.path.isfile(os.path.expanduser(args[0])):
+                return kind, "No such file: {0}".format(args[0])
+            if not os.path.isabs(args[1]):
+                return kind, "The remote path has to be absolute: {0}".format(args[1])
+        elif name == 'query':
+            query = line.split()
+            if query[1:2] == ['grep']:
+                if len(query) not in [3, 4]:
+                    return kind, "Usage: ? grep regex [jobid]"
+                try:
+                    re.compile(query[2])
+                except re.error as e:
+                    return kind, "Invalid regex {0}: {1}".format(query[2], e)
+            elif len(query) == 2 and query[1] != 'failed' and not re.match('^' + jid_re + '$', query[1]):
+                return kind, "Not a job number: {0}".format(query[1])
+            elif len(query) > 2 and query[1] != 'failed':
+                return kind, "Invalid command."
+        elif name == 'hostfile':
+            fname = os.path.expanduser(line[1:].strip())
+            if not os.path.exists(fname):
+                return kind, "No such file: {0}".format(fname)
+        elif name == 'filter':
+            command = line.split()
+            if len(command) == 2:
+                try:
+                    re.compile(command[1])
+                except re.error as e:
+                    return kind, "Invalid hostspec {0}: {1}".format(command[1], e)
+            elif len(command) == 4:
+                key = command[1].lower()
+                if self.config and self.config.has_option('pillar_map', key):
+                    key = self.config.get('pillar_map', key)
+                if command[2] not in ['==', '!=']:
+                    return kind, "{0} is not a valid comparision option.".format(command[2])
+                if self.pillars and key not in self.pillars:
+                    close = self.catalog and difflib.get_close_matches(key, self.catalog.keys, 3)
+                    return kind, "'{0}' is not a valid pillar to filter by.{1}".format(
+                        command[1], close and " Did you mean: {0}?".format(", ".join(close)) or '')
+            else:
+                return kind, "Unrecognized command format/input: {0}".format(line)
+        elif name == 'reduce':
+            reduce = reduce_re.match(line)
+            if not reduce:
+                return kind, "Usage: reduce stats|hist $N command"
+            if find_command(reduce.group(3))[0] != 'task':
+                return kind, "Only commands run on minions can be reduced, try '?? | {0} ${1}'.".format(
+                    reduce.group(1), reduce.group(2))
+            return kind, self.classify(reduce.group(3))[1]
+        elif name == 'task':
+            try:
+                parse_module_call(line)
+            except ValueError as e:
+                return kind, "Arguments have to be plain values (strings, numbers, lists, ...): {0}".format(e)
+        return kind, None
+
+    def run_script(self, lines):
+        """ Run a script that's already been checked. Jobs get published
+            by the pipeline (unless --serial), and every line that isn't
+            a filter, a setting or another job waits for them first.
+            The pillar index tells the pipeline which jobs can't overlap,
+            but it isn't fetched just for that: without it every job is
+            taken to overlap with the ones before. """
+        if not opts.serial and not opts.noop:
+            self.pipeline = Pipeline(int(self.get_option('pipeline_threads', 8)))
+        try:
+            for where, line in lines:
+                if self.pipeline and find_command(line)[1] == 'query':
+                    self.drain()
+                self.parse_and_run(line)
+                self.finish_timer()
+        finally:
+            self.drain()
+            self.pipeline = None
+
+    def drain(self):
+        """ Wait for the pipeline to publish everything it was given and
+            report on it in script order. """
+        if self.pipeline is None:
+            return
+        for submission in self.pipeline.drain():
+            self.report_published(submission.job, submission.messages)
+
+    def fetch_pillars(self, client=None):
+        """ Load pillars for myself to get a list to display
+            as possible options. I copy the data to self to
+            preserve types and such, and maybe the example
+            data being available will be useful later. """
+        client = client or self.salt
+        pillars = client.cmd(self.fqdn, 'pillar.raw', [''])[self.fqdn]
+        return dict((k, v) for k, v in pillars.items() if not k.startswith('graindiff'))
+
+    def load_pillars(self):
+        """ Use the on-disk pillar cache when there is one so startup
+            doesn't wait on a round trip to the master. A stale cache is
+            still used right away, and a background thread swaps in
+            fresh data (and rewrites the cache) once it arrives. A run
+            that's over before then waits up to pillar_refresh_wait
+            seconds for it on the way out, or short scripts would never
+            get the cache rewritten. """
+        pillars, age = None, None
+        if not opts.refresh_pillars or opts.offline:
+            pillars, age = self.cache.load('pillars-' + self.fqdn)
+        if opts.offline:
+            # However old, the cache is all there is without salt.
+            self.pillars = pillars or {}
+            if not pillars:
+                print "No cached pillars, so pillar filters can't be checked offline."
+            return
+        if pillars:
+            self.pillars = pillars
+            if opts.verbose:
+                print "Loaded {0} pillars from cache ({1:.0f}s old).".format(len(pillars), age)
+            if not self.cache.is_fresh(age):
+                worker = threading.Thread(target=self.revalidate_pillars)
+                worker.daemon = True
+                worker.start()
+                atexit.register(worker.join, float(self.get_option('pillar_refresh_wait', 30)))
+            return
+
+        print "Loading available pillars.",
+        sys.stdout.flush()
+        self.pillars = self.fetch_pillars()
+        self.cache.store('pillars-' + self.fqdn, self.pillars)
+        print "   Done!"
+
+    def revalidate_pillars(self):
+        """ Runs in its own thread with its own client, since a
+            LocalClient shouldn't be shared between threads. """
+        try:
+            pillars = self.fetch_pillars(self.masters[0].new_client())
+        except Exception as e:
+            if opts.verbose:
+                print >>sys.stderr, "Background pillar refresh failed: {0}".format(e)
+            return
+        self.pillars = pillars
+        self.cache.store('pillars-' + self.fqdn, pillars)
+
+    def load_index(self, refresh=False):
+        """ Pull every minion's pillar data out of the master's cache
+            (no minion round trip) into a local PillarIndex. The first
+            call builds it, later calls with refresh only re-index the
+            minions whose data changed. """
+        if not opts.use_pillars or (opts.offline and not refresh):
+            return None
+        if self.index is not None and not refresh:
+            return self.index
+        print "Loading fleet pillar index.",
+        sys.stdout.flush()
+        pillars = {}
+        for master, cached in self.on_masters(lambda master: master.runner.cmd('cache.pillar', ['*']) or {}):
+            pillars.update(cached)
+        for pillar in pillars.values():
+            if isinstance(pillar, dict):
+                for key in [k for k in pillar if k.startswith('graindiff')]:
+                    del pillar[key]
+        if self.index is None:
+            self.index = PillarIndex()
+        changed = self.index.update(pillars)
+        print "   Done! {0} minions, {1} updated.".format(len(self.index), changed)
+        # Values whose last minion went away in a refresh are still in
+        # the index, with an empty set.
+        values = dict((key, [value for value, mids in values.items() if mids])
+                      for key, values in self.index.values.items())
+        self.catalog = Catalog(values, self.pillar_aliases())
+        self.cache.store('catalog-' + self.fqdn, values)
+        return self.index
+
+    def pillar_aliases(self):
+        if self.config and self.config.has_section('pillar_map'):
+            return dict(self.config.items('pillar_map'))
+        return {}
+
+    def load_catalog(self):
+        """ The fleet's pillar keys and values, for completing filters
+            and catching typos in them. They come from the last pillar
+            index that was built (so from disk, without asking the
+            master) and until there is one just the pillar names. """
+        values, age = self.cache.load('catalog-' + self.fqdn)
+        if values is None:
+            values = dict((key, []) for key in self.pillars)
+        self.catalog = Catalog(values, self.pillar_aliases())
+
+    def complete(self, text, state):
+        """ readline completer for filter lines: pillar names, then the
+            operator, then the values the fleet has for that pillar. """
+        if state == 0:
+            self.completions = []
+            try:
+                words = readline.get_line_buffer()[:readline.get_begidx()].split()
+                if self.catalog and words and words[0] in ['+', '-', '=']:
+                    if len(words) == 1:
+                        self.completions = self.catalog.complete_key(text)
+                    elif len(words) == 2:
+                        self.completions = [op for op in ['==', '!='] if op.startswith(text)]
+                    elif len(words) == 3 and words[2] in ['==', '!=']:
+                        self.completions = self.catalog.complete_value(words[1].lower(), text)
+            except Exception:
+                pass
+        if state < len(self.completions):
+            return self.completions[state] + ' '
+        return None
+
+    def check_filters(self):
+        """ Reasons the current filters can't match anything, found
+            without asking the master. Only contradictions are returned,
+            those really can't match. The pillar index may be out of
+            date, so nothing in it matching is only warned about. It's
+            only used if it is already loaded, so this never costs a
+            fleet wide fetch. """
+        problems = find_contradictions(self.filters)
+        if not problems and self.index:
+            resolved = self.index.resolve(self.filters)
+            if resolved and resolved[-1][2] == 0:
+                print >>sys.stderr, wrap("No host in the local pillar index matches all filters."
+                                         " Try 'refresh' if it might be out of date.", attr.bright, fgcolor.yellow)
+        return problems
+
+    def display_matches(self):
+        """ Resolve the current filter stack against the local
+            pillar index and show how many hosts each step leaves. """
+        for problem in find_contradictions(self.filters):
+            print wrap(problem, attr.bright, fgcolor.red)
+        index = self.load_index()
+        if not index:
+            return
+        _padder(" Local match counts ({0} minions indexed) ".format(len(index)))
+        for filter, matched, remaining in index.resolve(self.filters):
+            print "{0:<40} {1:>7} match {2:>7} remaining".format(filter_text(filter), matched, remaining)
+            if remaining == 0:
+                print wrap("  ^ Nothing is left to target after this filter!", attr.bright, fgcolor.red)
+
+    def run_server(self, path):
+        """ Keep this shell, its clients, pillars, caches and job table
+            warm and run requests from 'fssh --connect' clients on a unix
+            socket. Only root and the user who started the server may
+            connect. Requests are handled one at a time, each starting
+            from no filters. """
+        if opts.use_pillars:
+            self.load_pillars()
+        if os.path.lexists(path):
+            # A socket left behind by an earlier server, never anything else.
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                print >>sys.stderr, "{0} exists and isn't a socket, not replacing it.".format(path)
+                sys.exit(2)
+            os.unlink(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0077)
+        try:
+            server.bind(path)
+        finally:
+            os.umask(umask)
+        owner = pwd.getpwnam(self.user).pw_uid
+        os.chown(path, owner, -1)
+        server.listen(16)
+        print "Serving on {0}".format(path)
+        try:
+            while True:
+                conn, address = server.accept()
+                try:
+                    creds = conn.getsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_PEERCRED', 17), struct.calcsize('3i'))
+                    pid, uid, gid = struct.unpack('3i', creds)
+                    if uid not in [0, owner]:
+                        print >>sys.stderr, "Refused connection from uid {0}".format(uid)
+                        continue
+                    request = ''
+                    while not request.endswith('\n'):
+                        data = conn.recv(65536)
+                        if not data:
+                            break
+                        request += data
+                    reply = self.serve_request(json.loads(request))
+                    conn.sendall(json.dumps(reply, default=str) + '\n')
+                except (socket.error, ValueError) as e:
+                    print >>sys.stderr, "Bad request: {0}".format(e)
+                finally:
+                    conn.close()
+        finally:
+            server.close()
+            os.unlink(path)
+
+    def serve_request(self, request):
+        """ Run the lines of one request with all output captured, and
+            return it along with every job that was submitted. """
+        saved = self.filters, self.job, self.batch, self.group_output, self.writer
+        self.filters, self.job, self.batch = [], [], None
+        first = len(self.jobs.jobs)
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = output = cStringIO.StringIO()
+        error = False
+        try:
+            for line in request.get('lines', []):
+                if line.startswith('.'):
+                    print "Sourcing files isn't supported over the socket: {0}".format(line)
+                    error = True
+                    continue
+                if find_command(line)[0] == 'output':
+                    # Returns that come in after the reply go through
+                    # whichever writer is set then.
+                    print "Output directories can only be set for the whole server: {0}".format(line)
+                    error = True
+                    continue
+                self.parse_and_run(line)
+                self.finish_timer()
+        except SystemExit:
+            pass
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            error = True
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            self.filters, self.job, self.batch, self.group_output, self.writer = saved
+
+        jobs = self.jobs.jobs[first:]
+        if request.get('wait'):
+            deadline = time.time() + float(request.get('timeout', self.get_option('job_timeout', 300)))
+            while time.time() < deadline and any(job.state == 'running' for job in jobs):
+                time.sleep(0.2)
+        reply = {'output': output.getvalue().decode('utf-8', 'replace'), 'error': error, 'jobs': []}
+        for job in jobs:
+            entry = {'jids': job.jids, 'command': job.command, 'target': job.target, 'state': job.state,
+                     'expected': job.expected is not None and sorted(job.expected) or None,
+                     'returned': len(job.returns), 'failed': job.failed()}
+            if request.get('wait'):
+                entry['returns'] = job.returns
+            reply['jobs'].append(entry)
+        # Nobody is going to ask about these again.
+        self.jobs.forget(jobs)
+        return reply
+
     def get_input(self):
         while True:
             self.curline += 1
             try:
                 if self.curfd.isatty():
+                    for job in self.jobs.pop_finished():
+                        print "[{0}] {1}: {2}".format(", ".join(job.jids), job.state, job.command)
+                        if opts.verbose and job.timer:
+                            print "  Timing: {0}".format(job.timer.summary())
+                        if job.missing():
+                            print "  {0} minions never returned, 'retry {1}' re-submits to just them.".format(
+                                len(job.missing()), job.jids[0])
                     line = raw_input('fssh> ')
                 else:
                     line = self.curfd.readline()
@@ -220,6 +2120,14 @@ class SaltShell(object):
             return line.strip()
 
     def parse_and_run(self, line):
+        """ run_line(), where a command that needs salt in a session
+            that can't have it only ends that command. """
+        try:
+            return self.run_line(line)
+        except NeedsRoot as e:
+            print >>sys.stderr, wrap(str(e), attr.bright, fgcolor.red)
+
+    def run_line(self, line):
 
         """
             More like, parse and then run.
@@ -244,7 +2152,16 @@ class SaltShell(object):
         """
 
         line = line.strip()
-        if line[0] == '.':
+        reduction = reduction_re.match(line)
+        if reduction:
+            self.reduction = (reduction.group(2), int(reduction.group(3)))
+            try:
+                return self.run_line(reduction.group(1))
+            finally:
+                self.reduction = None
+        self.timer = Timer(line, self.timings)
+        name = find_command(line)[0]
+        if name == 'source':
             """ TODO: This code is just grandfathered in.
                 I don't really know if anyone uses it. """
             self.files.insert(0, (self.curfile, self.curfd, self.curline))
@@ -256,18 +2173,22 @@ class SaltShell(object):
                 print "File {0} not found or unable to open it.".format(line[1:])
                 print e
             return
-        if line == 'help':
+        if name == 'help':
             run_help()
             return
-        elif line in ['clear', 'reset']:
+        elif name == 'clear':
             self.filters = []
-            self.job = ''
+            self.job = []
             print "Filters and jobid (if any) have been reset!"
             return
-        elif line in ['exit', 'quit']:
+        elif name == 'refresh':
+            if self.load_index(refresh=True) is None:
+                print "Using pillars was disabled at run time."
+            return
+        elif name == 'exit':
             self.run_exit()
             return # lol
-        elif line in ['meow']:
+        elif name == 'meow':
             print """
             .                .
             :"-.          .-";
@@ -297,15 +2218,51 @@ class SaltShell(object):
        /         .__  __.         \\
       : / ,       / "" \       . \ ; bug
        "-:___..--"      "--..___;-" """
-        elif line[0:2] == '??':
+        elif name == 'batch':
+            return self.run_batch_command(line.split()[1:])
+        elif name == 'put':
+            return self.run_put(line.split()[1:])
+        elif name == 'group':
+            if line != 'group':
+                self.group_output = line == 'group on'
+            print "Grouping identical output is {0}.".format(self.group_output and 'on' or 'off')
+            return
+        elif name == 'output':
+            return self.run_output_command(line.split()[1:])
+        elif name == 'jobs':
+            return self.run_jobs_command()
+        elif name == 'timing':
+            return self.run_timing_command(line.split()[1:])
+        elif name == 'wait':
+            return self.run_wait_command(line.split())
+        elif name == 'watch':
+            if line[5:].strip():
+                self.job = self.expand_jids([line[5:].strip()])
             if self.job:
-                self.run_query()
+                self.run_watch()
+            else:
+                print "There's no job to watch."
+            return
+        elif name == 'reduce':
+            return self.run_reduce(line)
+        elif name == 'lookup':
+            if self.job:
+                self.on_results(self.run_query)
             else:
                 print "There's no job to lookup."
                 return
-        elif line[0] == '?':
+        elif name in ['summary', 'query']:
             return self.run_query_command(line)
-        elif line[0] in ['+', '-', '=']:
+        elif name == 'hostfile':
+            fname = os.path.expanduser(line[1:].strip())
+            if not os.path.exists(fname):
+                print "No such file: {0}".format(fname)
+                return
+            with open(fname) as fd:
+                return self.add_host_list(read_host_file(fd))
+        elif name == 'hostlist':
+            return self.add_host_list(re.split('[\s,]+', line[1:].strip()))
+        elif name == 'filter':
             command = line.split()
 
             if len(command) == 4:
@@ -328,6 +2285,9 @@ class SaltShell(object):
                     print "'{0}' is not a valid pillar to filter by.\nTry one of these:".format(command[1])
                     for pillar in self.pillars:
                         print "{0} {1}".format(type(self.pillars[pillar]), pillar)
+                    close = self.catalog and difflib.get_close_matches(command[1], self.catalog.keys, 3)
+                    if close:
+                        print "Did you mean: {0}?".format(", ".join(close))
                     return
 
                 """ Strip leading and trailing quote characters. """
@@ -351,16 +2311,20 @@ class SaltShell(object):
             _padder("~ Current Summary ~")
             if len(self.filters) > 0:
                 display_filters(self.filters)
-                self.display_cli_guess("<your command here>")
+                self.display_matches()
+                self.display_cli_guess("'<your command here>'")
                 _padder()
             else:
                 print "Nothing! Try adding some filters!"
+            if self.batch:
+                print "Batch mode: {0} hosts at a time, aborting once failures exceed {1} of the hosts.".format(*self.batch)
             return
+        elif query[1] in ['grep', 'failed']:
+            return self.on_results(self.run_search, query[1:])
         elif len(query) == 2:
-            if query[1].isdigit():
-                """ TODO: Lookup job id here. """
-                self.job = query[1]
-                self.run_query()
+            if re.match('^' + jid_re + '$', query[1]):
+                self.job = self.expand_jids([query[1]])
+                self.on_results(self.run_query)
                 return
             else:
                 print >>sys.stderr, "Invalid input or not a job number (isdigit): {0}".format(query[1])
@@ -369,6 +2333,66 @@ class SaltShell(object):
             print "Error: Invalid command."
             return
 
+    def set_output_dir(self, path):
+        """ Send job output to files under path from now on, or back to
+            the terminal if path is None. """
+        if self.writer:
+            self.writer.flush()
+        if not path:
+            self.writer = None
+            return
+        path = os.path.abspath(os.path.expanduser(path))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.writer = OutputWriter(path, int(self.get_option('output_buffer_size', 4194304)))
+        atexit.register(self.writer.flush)
+
+    def run_output_command(self, args):
+        """ output [directory|off] """
+        if args == ['off']:
+            self.set_output_dir(None)
+        elif args:
+            try:
+                self.set_output_dir(args[0])
+            except (OSError, IOError) as e:
+                print >>sys.stderr, "Can't write output to {0}: {1}".format(args[0], e)
+                return
+        if self.writer:
+            print "Job output goes to {0}/<jobid>/<minion>.out, .err and .rc.".format(self.writer.directory)
+        else:
+            print "Job output is printed."
+
+    def run_batch_command(self, args):
+        """ batch [size [max_fail%]] / batch off """
+        if args == ['off']:
+            self.batch = None
+        elif args:
+            max_fail = len(args) > 1 and args[1] or self.get_option('batch_max_fail', '10%')
+            self.batch = (args[0], max_fail)
+        if self.batch:
+            print "Batch mode: {0} hosts at a time, aborting once failures exceed {1} of the hosts.".format(*self.batch)
+        else:
+            print "Batch mode is off, commands go to every host at once."
+
+    def add_host_list(self, hosts):
+        """ Here you have told me to run it on specific hosts, either
+            from a file with '< file' or with '= host1,host2,...'.
+            Explicit lists used to fail on long lists. It's more of a
+            character limit than a host limit, and when you hit it
+            everything still *appears* to work: the job is submitted and
+            you get a jobid back but nothing is actually done with it.
+            Things started falling apart somewhere between 1,000 and 2,000
+            hosts. So the list gets compressed into a regex, and split
+            over as many jobs as it takes to keep each target short. """
+        hosts = [h for h in hosts if h and not h.startswith('#')]
+        if not hosts:
+            print "No hosts given."
+            return
+        hostlist = HostList(hosts, int(self.get_option('max_target_length', 16384)))
+        if len(hostlist.shards) > 1:
+            print "Targeting {0}, commands will be split over that many jobs.".format(hostlist)
+        self.filters.append(['+', '<', hostlist])
+
     def run_admin_command(self, line):
 
         """ This is where you'd do verification of
@@ -376,27 +2400,11 @@ class SaltShell(object):
 
         if line[0] == '=':
             """ Discouraged: Here you have told me to run it on a specific host
-            via the legacy '= hostspec' format. This will work, but will
-            fail on long lists. It's more of a character limit than a host limit
-            so it's not really fair to remove it entirely because you can work on
-            small sets of hosts. The bad news is that when you hit that limit, 
-            everything still *appears* to work. It will submit the job and give
-            you a jobid back but nothing will actually be done with it.
-            Things started falling apart somewhere between 1,000 and 2,000 hosts.
-            """
+            via the legacy '= hostspec' format. A single hostspec is used as
+            is, lists of hosts are handled by add_host_list. """
             line[0] = '+'
 
         if len(line) == 2:
-            if line[0] == '<':
-                fname = line[1:]
-                """ TODO: This probably doesn't work,
-                    and what it should be doing likely doesn't
-                    belong in this part of the application. """
-                if not os.path.exists(fname):
-                    print "No such file: {0}".format(fname)
-                    return set()
-                with open(fname) as fd:
-                    query = ';'.join(set([x.strip() for x in fd.read().strip().splitlines()]))
             if line[1] == '.*':
                 _padder(" ! Hey there meow ! ")
                 _padder()
@@ -408,10 +2416,15 @@ class SaltShell(object):
 
         elif len(line) == 4:
 
-            attr, op, val = line[1:]
+            key, op, val = line[1:]
             matched = []
             if op not in ['==','!=']:
                 print "Err: {0} is not a valid comparision option.".format(op)
+            elif self.catalog and not self.catalog.has(key, val):
+                close = self.catalog.suggest(key, val)
+                print wrap("No host has {0} == {1} as far as the pillar catalog knows.{2}".format(
+                    key, val, close and " Did you mean: {0}?".format(", ".join(close)) or ''),
+                    attr.bright, fgcolor.yellow)
 
         else:
             raise Exception, "Unsupported query/command." "Got: {0}".format(line)
@@ -419,52 +2432,497 @@ class SaltShell(object):
         self.filters.append(line)
         return
 
+    def fetch_job(self, jid):
+        """ Make sure the result store has everything the master has
+            for a job. Jobs the store has in full aren't fetched again. """
+        if self.results.is_complete(jid):
+            return
+        raw, master = self.split_jid(jid)
+        if master is None:
+            print >>sys.stderr, "There's no master {0} in [masters].".format(jid.partition('@')[2])
+            return
+        job = master.runner.cmd('jobs.list_job', [raw]) or {}
+        result = job.get('Result') or {}
+        self.results.lost.discard(jid)
+        self.results.add_many(jid, result)
+        minions = job.get('Minions') or []
+        self.results.set_expected(jid, minions)
+        if jid in self.results.lost:
+            # Reading it back would miss whatever couldn't be saved.
+            raise sqlite3.OperationalError("couldn't save the returns of {0}".format(jid))
+        if minions and set(minions) <= set(result):
+            self.results.mark_complete(jid)
+
+    def fetch_jobs(self, jids):
+        """ fetch_job() for each jid, every master at once. """
+        if len(self.masters) == 1:
+            for jid in jids:
+                self.fetch_job(jid)
+            return
+        unknown = [jid for jid in jids if self.split_jid(jid)[1] is None]
+        for jid in unknown:
+            self.fetch_job(jid)
+        self.on_masters(lambda master: [self.fetch_job(jid) for jid in jids
+                                        if self.split_jid(jid)[1] is master])
+
+    def new_output(self):
+        if self.reduction:
+            return ReducedOutput(*self.reduction)
+        if self.writer and self.job:
+            return FileOutput(self.writer, self.job[0])
+        return self.group_output and GroupedOutput() or PlainOutput()
+
     def run_query(self):
-        return self.run('runner', 'jobs.lookup_jid', [ self.job ])
+        output = self.new_output()
+        try:
+            # One view over every jid of the job, whichever master or
+            # shard or retry it came from.
+            self.fetch_jobs(self.job)
+            self.mark('fetch')
+            for minion, ret, retcode in self.results.iter_returns(self.job):
+                output.add(minion, ret, retcode)
+        except KeyboardInterrupt:
+            print >>sys.stderr, "KeyboardInterrupt."
+        output.finish()
+        self.mark('render')
+        self.report_missing(self.results.missing(self.job))
+
+    def report_missing(self, missing, total=None):
+        if not missing:
+            return
+        hosts = HostRanges()
+        for minion in missing:
+            hosts.add(minion)
+        count = total and "{0} of {1}".format(len(missing), total) or len(missing)
+        print wrap("{0} targeted minions have not returned: {1}".format(count, hosts), attr.bright, fgcolor.yellow)
+
+    def run_search(self, query):
+        """ ? grep regex [jobid] / ? failed [jobid ...|last N] """
+        if query[0] == 'grep':
+            if len(query) not in [2, 3]:
+                print "Usage: ? grep regex [jobid]"
+                return
+            try:
+                re.compile(query[1])
+            except re.error as e:
+                print "Invalid regex {0}: {1}".format(query[1], e)
+                return
+            jids = self.expand_jids(query[2:]) or self.job
+        elif query[1:2] == ['last'] and query[2:3] and query[2].isdigit():
+            jids = self.results.last(int(query[2]))
+        else:
+            jids = self.expand_jids(query[1:]) or self.job
+        if not jids:
+            print "There's no job to search."
+            return
+        self.fetch_jobs(jids)
+        self.mark('fetch')
+        if query[0] == 'grep':
+            minions = self.results.grep(query[1], jids)
+            _padder(" Minions whose output matched {0} in {1} ".format(query[1], ", ".join(jids)))
+        else:
+            minions = self.results.failed(jids)
+            _padder(" Minions that failed in {0} ".format(", ".join(jids)))
+        self.mark('search')
+        for minion in minions:
+            print minion
+        _padder(" {0} minions ".format(len(minions)))
+
+    def start_tracker(self):
+        """ Start the background thread that follows every job in the
+            job table. Its event subscription is made here, before
+            anything is published, so no return can slip past it. """
+        if self.tracker is None:
+            events = EventSource(self.masters)
+            # Opened here, so the tracker and this thread can't both
+            # open it at once.
+            self.results
+            self.tracker = threading.Thread(target=self.run_tracker, args=(events,))
+            self.tracker.daemon = True
+            self.tracker.start()
+
+    def run_tracker(self, events):
+        """ Record every job return off the event bus, and ask the
+            master once per job which minions it was sent to, so a job
+            can be called done. Uses its own runners since clients
+            shouldn't be shared between threads. """
+        runners = dict((master, master.new_runner()) for master in self.masters)
+        timeout = float(self.get_option('job_timeout', 300))
+        asked = {}
+        while True:
+            try:
+                for job in self.jobs.outstanding():
+                    if job.expected is None and job.jids and time.time() - asked.get(job, 0) > 5:
+                        asked[job] = time.time()
+                        for jid in list(job.jids):
+                            raw, master = self.split_jid(jid)
+                            info = runners[master].cmd('jobs.list_job', [raw]) or {}
+                            self.results.set_expected(jid, info.get('Minions') or [])
+                            self.jobs.set_expected(job, info.get('Minions') or [], info.get('Result') or {})
+                # What came in so far is committed before waiting.
+                got = self.results.pending and events.get_return(None, 0.05)
+                if not got:
+                    self.results.flush()
+                    got = events.get_return(None, 1)
+                writer = self.writer
+                if got:
+                    job = self.jobs.record(*got)
+                    if job:
+                        self.results.add(*got, commit=False)
+                        if writer:
+                            jid, minion, data = got
+                            if not isinstance(data, dict):
+                                data = {'return': data}
+                            writer.add(job.jids[0], minion, data.get('return'), data.get('retcode', 0))
+                        if job.state == 'done':
+                            for jid in job.jids:
+                                self.results.mark_complete(jid)
+                elif writer:
+                    writer.flush()
+                self.jobs.expire(timeout)
+                for job in self.jobs.pop_unlogged():
+                    if job.timer:
+                        self.log_timing(job.timer)
+            except Exception as e:
+                if opts.verbose:
+                    print >>sys.stderr, "Job tracker: {0}".format(e)
+                time.sleep(1)
+
+    def mark(self, phase):
+        """ The current command line is done with phase. """
+        if self.timer:
+            self.timer.mark(phase)
+
+    def finish_timer(self):
+        """ Print (with -v) and log how long the last line took. A job's
+            timings are logged once it has finished instead. """
+        timer = self.timer
+        if not timer or not timer.marks:
+            return
+        if opts.verbose:
+            print "Timing: {0}".format(timer.summary())
+        if timer.job is None:
+            self.log_timing(timer)
+
+    def log_timing(self, timer):
+        """ Append a line of json to the stats_file, if there is one. """
+        path = self.get_option('stats_file')
+        if not path:
+            return
+        try:
+            with open(os.path.expanduser(path), 'a') as fd:
+                fd.write(json.dumps(timer.record(), sort_keys=True) + '\n')
+        except IOError as e:
+            print >>sys.stderr, "Unable to write stats to {0}: {1}".format(path, e)
+
+    def run_timing_command(self, args):
+        """ timing [jobid] """
+        if args:
+            job = self.jobs.find(args[0])
+            timer = job and job.timer
+            if not timer:
+                print "No timings for job {0} in this session.".format(args[0])
+                return
+        elif self.timings:
+            timer = self.timings[-1]
+        else:
+            print "Nothing has been timed yet."
+            return
+        _padder(" Timing: {0} ".format(timer.line[:get_columns() - 20]))
+        print "{0:<16} {1:>12} {2:>12}".format('PHASE', 'AT', 'TOOK')
+        for phase, at, took in timer.phases():
+            print "{0:<16} {1:>10.1f}ms {2:>10.1f}ms".format(phase, at * 1000, took * 1000)
+        job = timer.job
+        if job:
+            print "{0}/{1} minions returned, job {2}.".format(
+                len(job.returns), job.expected is None and '?' or len(job.expected), job.state)
+
+    def run_jobs_command(self):
+        jobs = self.jobs.jobs
+        if not jobs:
+            print "No jobs submitted yet."
+            return
+        _padder(" Jobs ")
+        print "{0:<22} {1:<10} {2:>13} {3:>7}  {4}".format('JID', 'STATE', 'RETURNED', 'FAILED', 'COMMAND')
+        for job in jobs:
+            expected = job.expected is None and '?' or len(job.expected)
+            print "{0:<22} {1:<10} {2:>13} {3:>7}  {4}".format(
+                job.jids and job.jids[0] or '-', job.state,
+                "{0}/{1}".format(len(job.returns), expected), job.failed(), job.command)
+            for jid in job.jids[1:]:
+                print "  {0}".format(jid)
+            print "  target: {0}".format(job.target)
+            if job.state != 'running' and job.missing():
+                hosts = HostRanges()
+                for minion in job.missing():
+                    hosts.add(minion)
+                print "  missing: {0}".format(hosts)
+
+    def run_wait_command(self, command):
+        """ wait [jobid] / retry [jobid] """
+        jid = command[1:] and command[1] or self.job and self.job[0]
+        job = jid and self.jobs.find(jid)
+        if not jid:
+            print "There's no job to {0}.".format(command[0] == 'wait' and 'wait on' or 'retry')
+        elif not job:
+            print "Job {0} wasn't submitted from this session.".format(jid)
+        elif command[0] == 'retry':
+            self.retry_job(job)
+        else:
+            self.wait_job(job)
+
+    def wait_job(self, job):
+        """ Wait on every targeted minion of a job. The ones that haven't
+            returned within straggler_timeout seconds get listed, and
+            re-submitted to up to retries times, waiting retry_backoff
+            seconds before the first retry and twice as long before each
+            one after that. """
+        timeout = float(self.get_option('straggler_timeout', 60))
+        retries = int(self.get_option('retries', 0))
+        backoff = float(self.get_option('retry_backoff', 10))
+        self.start_tracker()
+        since = job.started
+        try:
+            while True:
+                while job.state == 'running' and time.time() < since + timeout:
+                    time.sleep(0.2)
+                missing = job.missing()
+                if missing is None:
+                    print "The master hasn't said which minions job {0} was sent to.".format(job.jids[0])
+                    return
+                if not missing:
+                    print "All {0} minions returned.".format(len(job.expected))
+                    return
+                self.report_missing(missing, len(job.expected))
+                if job.retries >= retries:
+                    return
+                delay = backoff * 2 ** job.retries
+                print "Retrying in {0:g}s ({1} of {2}).".format(delay, job.retries + 1, retries)
+                time.sleep(delay)
+                if not self.retry_job(job):
+                    return
+                since = time.time()
+        except KeyboardInterrupt:
+            print >>sys.stderr, "KeyboardInterrupt. Stopped waiting on job {0}.".format(job.jids[0])
+
+    def retry_job(self, job):
+        """ Re-submit a job to just the minions that haven't returned,
+            as another jid of the same job. """
+        missing = job.missing()
+        if missing is None:
+            print "The master hasn't said which minions job {0} was sent to.".format(job.jids[0])
+            return False
+        if not missing:
+            print "Every minion job {0} was sent to has returned.".format(job.jids[0])
+            return False
+        if job.call is None:
+            print "Job {0} can't be re-submitted.".format(job.jids[0])
+            return False
+        module, args, kwargs = job.call
+        # Each straggler goes back through the master it was sent from.
+        stragglers = {}
+        for jid, minions in job.sent.items():
+            stragglers.setdefault(self.split_jid(jid)[1], set()).update(minions & set(missing))
+
+        def resubmit(master):
+            targets = sorted(stragglers.get(master, ()))
+            return targets and master.client.run_job(targets, module, args, expr_form='list', kwarg=kwargs) or {}
+
+        jids = []
+        for master, pub in self.on_masters(resubmit):
+            if not pub.get('jid'):
+                if stragglers.get(master):
+                    print >>sys.stderr, "There was an error re-submitting job {0}.".format(job.jids[0])
+                continue
+            jid = qualify_jid(pub['jid'], master.name)
+            jids.append(jid)
+            job.sent[jid] = set(pub.get('minions') or stragglers[master])
+            self.results.add_many(jid, self.jobs.add_jid(job, jid))
+            self.results.set_expected(jid, job.sent[jid])
+        if not jids:
+            return False
+        self.jobs.resume(job)
+        self.job = list(job.jids)
+        print "Re-submitted to {0} minions: {1}".format(len(missing), ", ".join(jids))
+        return True
+
+    def get_events(self):
+        if self.events is None:
+            self.events = EventSource(self.masters)
+        return self.events
+
+    def run_reduce(self, line):
+        """ 'reduce stats|hist $N command': run command, then watch it
+            with the returns summarized as for '?? | stats $N'. A batch
+            shows its returns as it goes, so it gets summarized there. """
+        reduce = reduce_re.match(line)
+        if not reduce:
+            print "Usage: reduce stats|hist $N command"
+            return
+        op, field, command = reduce.group(1), int(reduce.group(2)), reduce.group(3)
+        if find_command(command)[0] != 'task':
+            print "Only commands run on minions can be reduced, try '?? | {0} ${1}'.".format(op, field)
+            return
+        job = self.job
+        self.reduction = (op, field)
+        try:
+            self.run_task(command)
+            if self.batch:
+                return
+            self.drain()
+            if self.job is not job:
+                self.run_watch()
+        finally:
+            self.reduction = None
+
+    def run_watch(self):
+        """ Print returns for the current job as they come in instead
+            of waiting on the job cache to have all of them. Stops once
+            every expected minion has answered, or nothing has come in
+            for watch_timeout seconds. """
+        timeout = float(self.get_option('watch_timeout', 60))
+        try:
+            # Subscribe before asking what's already there, so nothing
+            # returning in between gets lost.
+            events = self.get_events()
+            expected = set()
+            returned = {}
+            for jid in self.job:
+                raw, master = self.split_jid(jid)
+                job = master and master.runner.cmd('jobs.list_job', [raw]) or {}
+                expected.update(job.get('Minions') or [])
+                for minion, data in (job.get('Result') or {}).items():
+                    returned[minion] = (jid, data)
+                # The job cache can lag behind, but a job from this session
+                # knows who it was sent to from the publish.
+                tracked = self.jobs.find(jid)
+                if tracked and tracked.sent.get(jid):
+                    expected.update(tracked.sent[jid])
+            self.mark('lookup')
+            seen = set()
+            total = expected and len(expected) or '?'
+            output = self.new_output()
+
+            def show(jid, minion, data):
+                if minion in seen:
+                    return
+                seen.add(minion)
+                self.results.add(jid, minion, data, commit=False)
+                if not isinstance(data, dict):
+                    data = {'return': data}
+                counter = "[{0}/{1}] ".format(len(seen), total)
+                output.add(minion, data.get('return'), data.get('retcode', 0), counter)
+
+            for minion, (jid, data) in sorted(returned.items()):
+                show(jid, minion, data)
+            while not expected or not expected <= seen:
+                # What came in so far is committed before waiting.
+                got = self.results.pending and events.get_return(self.job, 0.05)
+                if not got:
+                    self.results.flush()
+                    got = events.get_return(self.job, timeout)
+                if got is None:
+                    output.finish()
+                    self.mark('watch')
+                    print "Nothing returned for {0:.0f}s, stopped watching. {1}/{2} returned.".format(timeout, len(seen), total)
+                    self.report_missing(sorted(expected - seen), len(expected))
+                    return
+                show(*got)
+            for jid in self.job:
+                self.results.mark_complete(jid)
+            output.finish()
+            self.mark('watch')
+            print "All {0} minions returned.".format(len(seen))
+        except KeyboardInterrupt:
+            self.results.flush()
+            output.finish()
+            print >>sys.stderr, "KeyboardInterrupt. Stopped watching job {0}.".format(", ".join(self.job))
 
     def run_task(self, line):
         command = line.strip()
 
-        """ Some logic to detect modules and their args here?
-            Run those instead, cmd.shell otherwise.
-            if re.match('^[a-zA-Z0-9]+\.[a-zA-Z0-9]+\(\\'.*\\'\)$' .... """
-        return self.run('salt', 'cmd.shell', [self.user, line])
+        """ Something that looks like module.function(args) gets run
+            as that execution module directly, which saves every minion
+            a shell and gives back structured data. cmd.shell otherwise. """
+        try:
+            call = parse_module_call(command)
+        except ValueError as e:
+            print >>sys.stderr, "Arguments have to be plain values (strings, numbers, lists, ...): {0}".format(e)
+            return
+        if call:
+            return self.run('salt', *call)
+        if self.writer:
+            # cmd.shell mixes stderr into stdout, cmd.run_all keeps them
+            # (and the retcode) apart for the .out, .err and .rc files.
+            return self.run('salt', 'cmd.run_all', [command], {'python_shell': True})
+        return self.run('salt', 'cmd.shell', [command])
 
     def run_exit(self):
         raise SystemExit()
 
-    def run(self, method, module, args):
+    def run(self, method, module, args, kwargs=None):
 
+        self.mark('parse')
         if method == 'salt' and len(self.filters) == 0:
             print >>sys.stderr, "Cannot run command on 0 hosts. And some filters!"
             return
 
+        if method == 'salt':
+            problems = self.check_filters()
+            for problem in problems:
+                print >>sys.stderr, wrap(problem, attr.bright, fgcolor.red)
+            if problems:
+                print >>sys.stderr, "Not submitting a job that can't match any host."
+                return
+
         try:
             if method == 'runner':
-                self.runner.cmd(module, args)
+                self.on_masters(lambda master: master.runner.cmd(module, args))
                 return
             elif method == 'salt':
-                if os.getuid() != 0:
+                if os.getuid() != 0 and not opts.noop:
                     """ Should do this check earlier. """
                     print >>sys.stderr, os.getuid()
                     print >>sys.stderr, "Can not run commands as a normal user."
                     sys.exit(7)
 
+                if self.batch and not opts.noop:
+                    self.drain()
+                    return self.run_batch(module, args, kwargs)
+
                 # Returns 0 on failure otherwise job id
                 if not opts.noop:
-                    job = self.salt.cmd_async(get_salt_filters(self.filters, self.pillars), module, [ args[1] ], expr_form='compound')
+                    self.start_tracker()
+                    targets = self.compile_targets()
+                    self.mark('target')
+                    tracked = Job(" or ".join(targets), self.describe_call(module, args, kwargs))
+                    tracked.call = (module, args, kwargs)
+                    tracked.timer = self.timer
+                    if self.timer:
+                        self.timer.job = tracked
+                    if self.pipeline is not None:
+                        # Published by a pipeline worker, reported once
+                        # the script gets to a line that needs it. An
+                        # empty index knows nothing, like no index.
+                        minions = None
+                        if self.index:
+                            minions = self.index.select(self.filters)
+                        self.pipeline.add(tracked, minions, lambda: self.publish(tracked, targets, module, args, kwargs,
+                                                                                 self.local_client))
+                        self.jobs.add(tracked)
+                        if opts.verbose:
+                            self.display_cli_guess(cli_args(args, kwargs), module=module)
+                            _padder()
+                        return
+                    self.jobs.add(tracked)
+                    messages = self.publish(tracked, targets, module, args, kwargs)
                     if opts.verbose:
-                        self.display_cli_guess(args[1])
-                        print "Job status: {0}".format(job)
+                        self.display_cli_guess(cli_args(args, kwargs), module=module)
                         _padder()
-                    if job != 0:
-                        self.job = job
-                        print "Job submitted successfully: {0}".format(job)
-                    else:
-                        print "There was an error executing your job!"
+                    self.report_published(tracked, messages)
                 else:
                     print "- In noop mode. Here's what I would be doing -"
-                    self.display_cli_guess(args[1])
+                    self.display_cli_guess(cli_args(args, kwargs), module=module)
                 return
             else:
                 print >>sys.stderr, "(Currently) Unsupported method: {0}\nGoodbye.".format(method)
@@ -473,15 +2931,342 @@ class SaltShell(object):
         except KeyboardInterrupt:
             print >>sys.stderr, "KeyboardInterrupt."
             return
+        except NeedsRoot:
+            raise
         except Exception:
             print >>sys.stderr, wrap("Couldn't process command", attr.bright, fgcolor.red)
             import traceback
             traceback.print_exc()
             return
 
+    def publish(self, tracked, targets, module, args, kwargs, client=None):
+        """ Send a tracked job to every master. client(master) gives the
+            LocalClient to use, by default each master's own one, one
+            thread per master. Returns what there is to say about it,
+            which is up to the caller to print. """
+        messages = []
+        minions = set()
+
+        # Unlike cmd_async, run_job hands back which minions the master
+        # sent the job to, not just the jid.
+        def submit(master):
+            local = client and client(master) or master.client
+            return [local.run_job(target, module, args, expr_form='compound', kwarg=kwargs) or {}
+                    for target in targets]
+
+        if client:
+            published = [(master, submit(master)) for master in self.masters]
+        else:
+            published = self.on_masters(submit)
+        for master, pubs in published:
+            for pub in pubs:
+                jid = pub.get('jid') and qualify_jid(pub['jid'], master.name)
+                if opts.verbose:
+                    messages.append("Job status: {0} ({1} minions)".format(jid, len(pub.get('minions') or [])))
+                if jid:
+                    tracked.sent[jid] = set(pub.get('minions') or [])
+                    minions.update(tracked.sent[jid])
+                    self.results.add_many(jid, self.jobs.add_jid(tracked, jid))
+                    self.results.set_expected(jid, tracked.sent[jid])
+                else:
+                    messages.append("There was an error executing your job{0}!".format(
+                        master.name and " on " + master.name or ""))
+        self.jobs.set_expected(tracked, minions, {})
+        if tracked.timer:
+            tracked.timer.mark('publish')
+        if not tracked.jids:
+            tracked.state = 'failed'
+        return messages
+
+    def report_published(self, tracked, messages):
+        for message in messages:
+            print message
+        if tracked.jids:
+            self.job = list(tracked.jids)
+            print "Job submitted successfully: {0}".format(", ".join(tracked.jids))
+
+    def local_client(self, master):
+        """ Clients shouldn't be shared between threads, so every
+            pipeline worker gets its own. """
+        clients = self.local.__dict__.setdefault('clients', {})
+        if master not in clients:
+            clients[master] = master.new_client()
+        return clients[master]
+
+    def compile_targets(self):
+        """ get_salt_targets() for the current filters, worked out once
+            per filter stack. """
+        key = tuple(tuple(filter) for filter in self.filters)
+        if key not in self.compiled:
+            if len(self.compiled) > 1000:
+                self.compiled.clear()
+            self.compiled[key] = get_salt_targets(self.filters, self.pillars)
+        return self.compiled[key]
+
+    def describe_call(self, module, args, kwargs):
+        if module == 'cmd.shell' or module == 'cmd.run_all' and kwargs == {'python_shell': True}:
+            return args[0]
+        return "{0} {1}".format(module, cli_args(args, kwargs)).rstrip()
+
+    def run_batch(self, module, arg, kwarg=None):
+        """ Run on the targeted minions a few at a time. A new host is
+            started as soon as one in flight returns, rather than waiting
+            on a whole wave. Once the failures exceed the allowed share
+            of the targeted hosts nothing new gets started, and whatever
+            is still in flight is waited on. """
+        size_spec, fail_spec = self.batch
+        print "Finding targeted minions.",
+        sys.stdout.flush()
+        targets = self.compile_targets()
+
+        def ping(master):
+            found = {}
+            for target in targets:
+                found.update(master.client.cmd(target, 'test.ping', expr_form='compound',
+                                               timeout=int(self.get_option('ping_timeout', 5))))
+            return found
+
+        # Which master to start each minion through.
+        where = {}
+        for master, found in self.on_masters(ping):
+            for minion in found:
+                where.setdefault(minion, master)
+        minions = sorted(where)
+        self.mark('ping')
+        print "   Done! {0} minions responded.".format(len(minions))
+        if not minions:
+            return
+        size = parse_percent(size_spec, len(minions))
+        max_fail = float(fail_spec.rstrip('%')) * len(minions) / 100
+        timeout = float(self.get_option('batch_timeout', 300))
+        # Subscribe before publishing anything so no return gets missed.
+        events = self.get_events()
+
+        pending = list(minions)
+        running = {}
+        done = failed = 0
+        output = self.new_output()
+        self.job = []
+        self.start_tracker()
+        tracked = Job("batch {0} of {1} hosts".format(size, len(minions)), self.describe_call(module, arg, kwarg))
+        tracked.expected = set(minions)
+        tracked.call = (module, arg, kwarg)
+        tracked.timer = self.timer
+        if self.timer:
+            self.timer.job = tracked
+        self.jobs.add(tracked)
+        try:
+            while pending or running:
+                if pending and len(running) < size:
+                    wave, pending = pending[:size - len(running)], pending[size - len(running):]
+                    for master in self.masters:
+                        hosts = [minion for minion in wave if where[minion] is master]
+                        if not hosts:
+                            continue
+                        job = master.client.cmd_async(hosts, module, arg, expr_form='list', kwarg=kwarg)
+                        if not job:
+                            print >>sys.stderr, "There was an error starting the job on {0}".format(", ".join(hosts))
+                            done += len(hosts)
+                            failed += len(hosts)
+                            continue
+                        job = qualify_jid(job, master.name)
+                        self.job.append(job)
+                        tracked.sent[job] = set(hosts)
+                        self.results.add_many(job, self.jobs.add_jid(tracked, job))
+                        self.results.set_expected(job, hosts)
+                        for minion in hosts:
+                            running[minion] = (job, time.time())
+
+                got = running and events.get_return(set(j for j, t in running.values()), 1)
+                if got:
+                    job, minion, data = got
+                    if running.get(minion, (None,))[0] == job:
+                        self.results.add(job, minion, data)
+                        del running[minion]
+                        done += 1
+                        if return_failed(data):
+                            failed += 1
+                        counter = "[{0}/{1}] ".format(done, len(minions))
+                        output.add(minion, data.get('return'), data.get('retcode', 0), counter)
+
+                for minion, (job, started) in running.items():
+                    if time.time() - started > timeout:
+                        del running[minion]
+                        done += 1
+                        failed += 1
+                        print wrap("{0} did not return within {1:.0f}s.".format(minion, timeout), attr.bright, fgcolor.red)
+
+                if pending and failed > max_fail:
+                    print wrap("{0} of {1} hosts failed, more than the {2} allowed. Not starting the remaining {3}.".format(
+                        failed, len(minions), fail_spec, len(pending)), attr.bright, fgcolor.red)
+                    pending = []
+        except KeyboardInterrupt:
+            output.finish()
+            print >>sys.stderr, "KeyboardInterrupt. {0} hosts were never started.".format(len(pending))
+            tracked.expected -= set(pending)
+            return
+        tracked.expected -= set(pending)
+        output.finish()
+        self.mark('batch')
+        print "Batch finished: {0} of {1} hosts done, {2} failed.".format(done, len(minions), failed)
+
+    def run_put(self, args):
+        """ put <local> <remote>: copy a file to the targeted minions.
+            Minions that already have an identical file (by sha256) are
+            skipped. Every chunk is compressed once and published once
+            (per master) to all the minions still getting the file, the
+            way salt-cp --chunked does it, and the result is checked
+            against the local hash at the end. """
+        if len(args) != 2:
+            print "Usage: put <local file> <remote path>"
+            return
+        local, remote = os.path.expanduser(args[0]), args[1]
+        if not os.path.isfile(local):
+            print "No such file: {0}".format(local)
+            return
+        if not os.path.isabs(remote):
+            print "The remote path has to be absolute: {0}".format(remote)
+            return
+        if len(self.filters) == 0:
+            print >>sys.stderr, "Cannot copy a file to 0 hosts. And some filters!"
+            return
+        problems = self.check_filters()
+        for problem in problems:
+            print >>sys.stderr, wrap(problem, attr.bright, fgcolor.red)
+        if problems:
+            return
+
+        size = os.path.getsize(local)
+        chunk_size = int(self.get_option('put_chunk_size', 1048576))
+        chunks = max(1, (size + chunk_size - 1) // chunk_size)
+        if opts.noop:
+            print "- In noop mode. Here's what I would be doing -"
+            _padder(" CLI equivalent ")
+            for target in self.compile_targets():
+                print "sudo salt-cp --chunked -C '{0}' {1} {2}".format(target, pipes.quote(local), pipes.quote(remote))
+            return
+
+        digest = hashlib.sha256()
+        with open(local, 'rb') as fd:
+            for data in iter(lambda: fd.read(chunk_size), ''):
+                digest.update(data)
+        digest = digest.hexdigest()
+        mode = oct(os.stat(local).st_mode & 07777)
+        timeout = int(self.get_option('put_timeout', 60))
+        targets = self.compile_targets()
+
+        def get_hashes(master, minions):
+            """ sha256 of remote on minions. """
+            return minions and master.client.cmd(minions, 'file.get_hash', [remote], kwarg={'form': 'sha256'},
+                                                 expr_form='list', timeout=timeout) or {}
+
+        def check(master):
+            """ Ask the targeted minions for their sha256 of remote.
+                Returns the jids, and the minions the master sent them to,
+                which the ones that don't answer are counted against. """
+            jids, minions = [], []
+            for target in targets:
+                pub = master.client.run_job(target, 'file.get_hash', [remote], expr_form='compound',
+                                            kwarg={'form': 'sha256'}) or {}
+                if pub.get('jid'):
+                    jids.append(qualify_jid(pub['jid'], master.name))
+                    minions += pub.get('minions') or []
+            return jids, minions
+
+        try:
+            print "Checking {0} on the targeted minions.".format(remote),
+            sys.stdout.flush()
+            # Subscribe before publishing anything so no return gets missed.
+            events = self.get_events()
+            jids, owner = set(), {}
+            for master, (found, minions) in self.on_masters(check):
+                jids.update(found)
+                owner.update((minion, master) for minion in minions)
+            hashes = {}
+            deadline = time.time() + timeout
+            while jids and set(owner) - set(hashes) and time.time() < deadline:
+                got = events.get_return(jids, deadline - time.time())
+                if got:
+                    jid, minion, data = got
+                    owner.setdefault(minion, self.split_jid(jid)[1])
+                    hashes[minion] = isinstance(data, dict) and data.get('return') or data
+            where = {}
+            same = []
+            failed = {}
+            for minion, master in owner.items():
+                if minion not in hashes:
+                    failed[minion] = "did not answer the hash check"
+                elif hashes[minion] == digest:
+                    same.append(minion)
+                else:
+                    where[minion] = master
+            self.mark('hash check')
+            print "   Done! {0} already have it, {1} need it, {2} didn't answer.".format(len(same), len(where), len(failed))
+            if not where:
+                for minion, reason in sorted(failed.items()):
+                    print wrap("{0}: {1}".format(minion, reason), attr.bright, fgcolor.red)
+                if failed:
+                    print "Copied to 0 minions, {0} failed, {1} already had it.".format(len(failed), len(same))
+                return
+
+            print "Sending {0} ({1} bytes, {2} chunks) to {3} minions.".format(local, size, chunks, len(where))
+            sent = 0
+            with open(local, 'rb') as fd:
+                for index in xrange(chunks):
+                    # Compressed once, whatever the number of minions.
+                    buf = cStringIO.StringIO()
+                    zipped = gzip.GzipFile(fileobj=buf, mode='wb')
+                    zipped.write(fd.read(chunk_size))
+                    zipped.close()
+                    chunk = base64.b64encode(buf.getvalue())
+                    sent += len(chunk)
+
+                    def send(master):
+                        minions = sorted(m for m, owner in where.items() if owner is master)
+                        return minions and master.client.cmd(minions, 'cp.recv_chunked', [remote, chunk, index > 0, True, mode],
+                                                             expr_form='list', timeout=timeout) or {}
+
+                    done = {}
+                    for master, returns in self.on_masters(send):
+                        done.update(returns)
+                    for minion in where.keys():
+                        if done.get(minion) is not True:
+                            failed[minion] = done.get(minion, "did not return")
+                            if isinstance(failed[minion], basestring) and 'is not available' in failed[minion]:
+                                failed[minion] = "cp.recv_chunked is not available, put needs salt 2016.11 or later " \
+                                                 "on the minions"
+                            del where[minion]
+                    if sys.stdout.isatty():
+                        sys.stdout.write("\r[{0}/{1}] chunks sent, {2} bytes on the wire per minion.".format(index + 1, chunks, sent))
+                        sys.stdout.flush()
+                    if not where:
+                        break
+            if sys.stdout.isatty():
+                print
+            self.mark('send')
+
+            verified = 0
+            for master, found in self.on_masters(lambda master: get_hashes(master, sorted(
+                    m for m, owner in where.items() if owner is master))):
+                for minion in [m for m, owner in where.items() if owner is master]:
+                    if found.get(minion) == digest:
+                        verified += 1
+                    else:
+                        failed[minion] = "checksum is {0}".format(found.get(minion, "unknown"))
+            for minion, reason in sorted(failed.items()):
+                print wrap("{0}: {1}".format(minion, reason), attr.bright, fgcolor.red)
+            self.mark('verify')
+            print "Copied to {0} minions, {1} failed, {2} already had it.".format(verified, len(failed), len(same))
+        except KeyboardInterrupt:
+            print >>sys.stderr, "KeyboardInterrupt. {0} may be left partly written on some minions.".format(remote)
+
     def display_cli_guess(self, command, interface = 'salt', module = 'cmd.shell'):
         _padder(" CLI equivalent ")
-        print "sudo {0} --async -C '{1}' {2} '{3}'".format(interface, get_salt_filters(self.filters, self.pillars), module, command)
+        mode = self.batch and "-b {0}".format(self.batch[0]) or "--async"
+        for master in self.masters:
+            config = master.name and "-c {0} ".format(os.path.dirname(master.config)) or ""
+            for target in self.compile_targets():
+                print "sudo {0} {1}{2} -C '{3}' {4} {5}".format(interface, config, mode, target, module, command).rstrip()
 
 class Attr(object):
     def __init__(self, **attr):
@@ -494,13 +3279,38 @@ def run_help():
 Query commands:
    ? [jobid]    Displays current settings.
                 If the optional jobid is supplied, look up that job number.
+                With several masters jobids look like jid@master, a bare jid
+                is looked up on every master.
   ??            Look up the results of the most recently run, or looked up job.
+   ? grep regex [jobid]
+                List the minions whose output matched regex in the current
+                (or given) job.
+   ? failed [jobid ...]
+   ? failed last N
+                List the minions that failed in any of the given jobs,
+                the current job, or the last N jobs.
+  ?? | stats $N
+  ?? | hist $N  Instead of the results, summarize field N (like awk, $0 is the
+                whole line) of every line that has a number there: count, sum,
+                mean, percentiles or a histogram, and the minions at either
+                end. Works after '? jobid' and 'watch' too.
+   reduce stats $N command
+   reduce hist $N command
+                Run command and watch it, summarizing field N as above.
+                Spelled out instead of piped, a '|' belongs to the command.
+   watch [jobid]
+                Print results of the current (or given) job as minions return
+                them, until every targeted minion has answered.
 
 Targeting/Filtering commands:
    + hostspec   Include this spec as a target.
    - hostspec   Exclude this spec as a target.
    = hostspec   Sets the hosts to use. This is discouraged.
                 If you'd like to know why, look for that word in the source.
+   = host1,host2,...
+   < file       Target exactly these hosts (from the file, one per line).
+                Long lists are compressed into a regex and, if that's still
+                too long, commands get split over several jobs.
 
    hostspecs should be PCRE compatible regexes. They need to match the
    *entire* hostname you wish to target. So '.*fe-web.*' not 'fe-web'. They
@@ -515,14 +3325,57 @@ Complex Targeting/Filtering:
     - env != production | Don't include a host whose environment is not production.
 
     For a list of available pillars, try matching on one that doesn't exist!
+    Tab completes pillar names (and pillar_map aliases), and after == or !=
+    the values hosts actually have for that pillar.
     Note that running ? after adding some filters will show you the equivalent
     salt CLI command, and that might make more sense logically when you see that.
 
     This magic depends on the magic of external pillars.
 
+Batch mode:
+    batch size [max_fail%]
+            Run commands on size (or size%) hosts at a time, starting the
+            next host as soon as one returns. Stop starting new hosts once
+            more than max_fail% of the targeted hosts have failed.
+    batch off
+            Go back to running commands on every targeted host at once.
+
 Special commands:
+    group [on|off]
+            Print minions with identical output once, under a compressed
+            list of their hostnames, instead of every minion separately.
+    output [directory|off]
+            Write the output of every minion to files of its own under
+            directory/jobid/ as it comes in, instead of printing it.
+    jobs    List every job submitted this session, how many of the targeted
+            minions have returned so far and how many of those failed.
+    wait [jobid]
+            Wait on every minion the current (or given) job was sent to.
+            The ones that haven't returned after straggler_timeout seconds
+            are listed and, if retries is set, the job is re-submitted to
+            just them, backing off a little more before every retry.
+    retry [jobid]
+            Re-submit the job right away to the minions that haven't
+            returned.
+    timing [jobid]
+            How long each phase of the last command (or the given job)
+            took: parsing, building the target, publishing, the first and
+            the last minion return, fetching and rendering results. -v
+            prints this after every command.
     clear   Reset your fssh environment, clears any existing filters and jobid
     reset   Same as clear.
+    refresh Re-read the fleet pillar index used by ? to count matching hosts.
+    put <local> <remote>
+            Copy a local file to remote (an absolute path) on the targeted
+            hosts. Hosts that already have an identical file are skipped.
+            The minions need salt 2016.11 or later.
+
+Running execution modules directly:
+
+   module.function(arg1, arg2, key=value)
+   Arguments are python literals. For example test.ping(), grains.item('os')
+   or disk.usage(). No shell is started on the minions and the results come
+   back as structured data.
 
 Running shell commands (basically anything else):
 
@@ -539,4 +3392,11 @@ reset = mode(attr.normal)
 wrap = lambda text, *args: sys.stdout.isatty() and "%s%s%s" % (mode(*args), text, reset) or text
 
 if __name__ == '__main__':
-    SaltShell(files, opts).run_shell()
+    try:
+        if opts.server:
+            SaltShell([], opts).run_server(opts.server)
+        else:
+            SaltShell(files, opts).run_shell()
+    except NeedsRoot as e:
+        print >>sys.stderr, e
+        sys.exit(7)
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+#
+# fssh_bench - time fssh's hot paths against a fake salt master
+#
+# Copyright (C) 2015-2016 Eric Webster <sophomeric@gmail.com>
+# see COPYING for license details
+
+# fssh imports salt after making sure it runs as root, and talks to a real
+# master from there on. This loads it the way the tests do, through
+# tests/fakesalt.py, with a stand-in for LocalClient, RunnerClient and the
+# event bus, simulating as many minions as asked for, and times the parts
+# of fssh that grow with the fleet. Results are compared against
+# fssh_bench.json, which --save writes. Timings are only comparable on the
+# same machine with the same options, so the baseline records both, isn't
+# part of the repo, and a baseline taken anywhere else is shown but never
+# fails the run.
+
+import collections
+import heapq
+import json
+import optparse
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, 'tests'))
+import fakesalt
+
+baseline_file = os.path.join(here, 'fssh_bench.json')
+
+p = optparse.OptionParser(usage="%prog [opts] [benchmark name prefixes]")
+p.add_option('-s', '--sizes', dest='sizes', action='store', default='1000,10000,50000',
+             help="Fleet sizes to simulate. Default=1000,10000,50000")
+p.add_option('-l', '--latency', dest='latency', type='float', default=0.0,
+             help="Average seconds before a minion's return shows up on the event bus. Default=0")
+p.add_option('-o', '--output-size', dest='output_size', type='int', default=64,
+             help="Bytes of output every minion returns. Default=64")
+p.add_option('-r', '--repeat', dest='repeat', type='int', default=3,
+             help="Runs of each benchmark, the fastest one counts. Default=3")
+p.add_option('-t', '--tolerance', dest='tolerance', type='float', default=25,
+             help="Percent slower than the baseline before it counts as a regression. Default=25")
+p.add_option('-b', '--baseline', dest='baseline', action='store', default=baseline_file,
+             help="Baseline to compare against. Default=fssh_bench.json next to this script")
+p.add_option('--save', dest='save', action='store_true', default=False,
+             help="Store the results as the new baseline.")
+opts, only = p.parse_args()
+
+
+class FakeMaster(object):
+    """ Everything the fake clients know: count minions with pillars,
+        the output they all return, and the jobs published so far. """
+
+    roles = ['web', 'db', 'cache', 'lb']
+    envs = ['prod', 'stage', 'dev']
+    dcs = ['ams', 'iad', 'sjc']
+    # Shared by every fleet size, since they share the result store.
+    jid = 20160101000000000000
+
+    def __init__(self, count, latency, output_size):
+        rng = random.Random(count)
+        self.minions = ["{0}{1:05d}.example.com".format(self.roles[i % 4], i) for i in xrange(count)]
+        self.pillars = dict((minion, {'role': self.roles[i % 4], 'env': self.envs[i % 3], 'dc': self.dcs[i % 5 % 3],
+                                      'tags': ['tag{0}'.format(i % 7)], 'graindiff_x': 1})
+                            for i, minion in enumerate(self.minions))
+        self.returns = {}
+        for minion in self.minions:
+            line = "{0:.2f} {1:.2f} {2:.2f} 1/100 {3}".format(rng.uniform(0, 10), rng.uniform(0, 10),
+                                                              rng.uniform(0, 10), rng.randint(1, 99999))
+            self.returns[minion] = (line + ' ' + 'x' * output_size)[:max(output_size, len(line))]
+        self.latency = latency
+        self.rng = rng
+        self.jobs = {}
+        self.buses = []
+
+    def publish(self, tgt, fun, form, returns=True):
+        """ Returns (jid, minions). With returns, every minion's return
+            lands on every event bus within 2 x latency seconds. """
+        FakeMaster.jid += 1
+        jid = str(FakeMaster.jid)
+        minions = form == 'list' and list(tgt) or self.minions
+        self.jobs[jid] = minions
+        now = time.time()
+        for bus in returns and self.buses or []:
+            for minion in minions:
+                due = now + self.rng.uniform(0, 2 * self.latency)
+                heapq.heappush(bus.pending, (due, 'salt/job/{0}/ret/{1}'.format(jid, minion),
+                                             {'id': minion, 'jid': jid, 'fun': fun, 'retcode': 0,
+                                              'return': self.returns[minion], 'success': True}))
+        return jid, minions
+
+master = None
+
+
+class LocalClient(object):
+    def __init__(self, c_path='/etc/salt/master', **kwargs):
+        pass
+
+    def cmd(self, tgt, fun, arg=(), **kwargs):
+        if fun == 'pillar.raw':
+            return {tgt: dict(master.pillars[master.minions[0]])}
+        return dict((minion, True) for minion in master.publish(tgt, fun, kwargs.get('expr_form'))[1])
+
+    def cmd_async(self, tgt, fun, arg=(), **kwargs):
+        return master.publish(tgt, fun, kwargs.get('expr_form'))[0]
+
+    def run_job(self, tgt, fun, arg=(), **kwargs):
+        jid, minions = master.publish(tgt, fun, kwargs.get('expr_form'))
+        return {'jid': jid, 'minions': minions}
+
+
+class RunnerClient(object):
+    def __init__(self, opts):
+        pass
+
+    def cmd(self, fun, arg=(), **kwargs):
+        if fun == 'cache.pillar':
+            return dict((minion, dict(pillar)) for minion, pillar in master.pillars.items())
+        if fun == 'jobs.list_job':
+            minions = master.jobs.get(arg[0], [])
+            return {'Minions': minions,
+                    'Result': dict((minion, {'return': master.returns[minion], 'retcode': 0}) for minion in minions)}
+        return {}
+
+
+class EventBus(object):
+    def __init__(self):
+        self.pending = []
+        master.buses.append(self)
+
+    def get_event(self, wait=5, tag='', full=False):
+        deadline = time.time() + wait
+        while True:
+            if self.pending and self.pending[0][0] <= time.time():
+                due, tag, data = heapq.heappop(self.pending)
+                return {'tag': tag, 'data': data}
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            time.sleep(min(remaining, self.pending and self.pending[0][0] - time.time() or remaining, 0.01))
+
+
+class Quiet(object):
+    """ Everything fssh prints goes to /dev/null while timing, so the
+        terminal isn't what's being measured. """
+
+    def __enter__(self):
+        self.saved = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = open(os.devnull, 'w')
+
+    def __exit__(self, *exc):
+        sys.stdout.close()
+        sys.stdout, sys.stderr = self.saved
+
+
+def make_script(lines):
+    """ A long fssh script of the usual things: filters, clears, mode
+        switches, shell commands and module calls. """
+    script = []
+    while len(script) < lines:
+        n = len(script)
+        script += ['+ web0{0}.*'.format(n % 10), '+ role == web', '- env != prod', '- .*{0}.example.com'.format(n % 97),
+                   'uptime', 'group on', 'test.ping()', 'grains.item("os", "kernel")', 'group off',
+                   '+ dc == ams', 'batch 10%', 'cat /proc/loadavg', 'batch off', 'clear']
+    return script[:lines]
+
+
+def make_filters(count):
+    filters = []
+    for i in xrange(count):
+        kind = i % 5
+        if kind == 0:
+            filters.append(['+', 'web{0:03d}.*'.format(i)])
+        elif kind == 1:
+            filters.append(['-', '.*-{0}.example.com'.format(i)])
+        elif kind == 2:
+            filters.append(['+', 'role', '==', FakeMaster.roles[i % 4]])
+        elif kind == 3:
+            filters.append(['-', 'env', '==', 'env{0}'.format(i)])
+        else:
+            filters.append(['+', 'dc', '!=', 'dc{0}'.format(i)])
+    return filters
+
+
+def benchmarks(fssh, shell, size):
+    """ (name, function) for every benchmark at this fleet size. The
+        functions get timed as a whole. """
+    found = []
+
+    def bench(name):
+        def register(fun):
+            found.append((name, fun))
+            return fun
+        return register
+
+    if size == sizes[0]:
+        script = make_script(5000)
+
+        @bench('script.parse_and_run[5000 lines]')
+        def run_script():
+            fssh.opts.noop = True
+            try:
+                for line in script:
+                    shell.parse_and_run(line)
+            finally:
+                fssh.opts.noop = False
+                shell.filters, shell.batch, shell.group_output = [], None, False
+
+        for count in [100, 300, 1000]:
+            filters = make_filters(count)
+
+            @bench('filters.get_salt_filters[{0} filters x100]'.format(count))
+            def build_filters(filters=filters):
+                for i in xrange(100):
+                    fssh.get_salt_filters(filters, shell.pillars)
+
+        @bench('pillars.load_pillars')
+        def load_pillars():
+            fssh.opts.refresh_pillars = True
+            try:
+                shell.load_pillars()
+            finally:
+                fssh.opts.refresh_pillars = False
+
+    @bench('pillars.load_index[{0}]'.format(size))
+    def load_index():
+        shell.index = None
+        shell.load_index()
+
+    @bench('pillars.refresh_index[{0}]'.format(size))
+    def refresh_index():
+        shell.load_index(refresh=True)
+
+    returns = sorted(master.returns.items())
+    for kind, output in [('plain', fssh.PlainOutput), ('grouped', fssh.GroupedOutput),
+                         ('stats', lambda: fssh.ReducedOutput('stats', 1)),
+                         ('hist', lambda: fssh.ReducedOutput('hist', 2))]:
+        @bench('render.{0}[{1}]'.format(kind, size))
+        def render(output=output):
+            rendered = output()
+            for minion, ret in returns:
+                rendered.add(minion, ret, 0)
+            rendered.finish()
+
+    @bench('query.lookup[{0}]'.format(size))
+    def lookup():
+        shell.job = [master.publish(master.minions, 'cmd.shell', 'list', returns=False)[0]]
+        shell.run_query()
+
+    @bench('query.watch[{0}]'.format(size))
+    def watch():
+        shell.filters = [['+', '.*']]
+        shell.parse_and_run('uptime')
+        shell.filters = []
+        shell.run_watch()
+
+    return found
+
+
+def run_benchmarks():
+    global master
+    results = collections.OrderedDict()
+    workdir = tempfile.mkdtemp(prefix='fssh_bench.')
+    config = os.path.join(workdir, 'fssh.conf')
+    with open(config, 'w') as fd:
+        fd.write("[main]\ncache_dir = {0}\nresult_db = {1}\nwatch_timeout = {2}\n".format(
+            os.path.join(workdir, 'cache'), os.path.join(workdir, 'results.db'), max(10, opts.latency * 4)))
+    os.environ['COLUMNS'] = '80'
+    master = FakeMaster(sizes[0], opts.latency, opts.output_size)
+    fssh = fakesalt.load_fssh(['-c', config], fakesalt.fake_salt(
+        LocalClient, RunnerClient, lambda opts, sock_dir, listen=True: EventBus()))
+    root = fakesalt.AsRoot()
+    try:
+        for size in sizes:
+            master = FakeMaster(size, opts.latency, opts.output_size)
+            with Quiet():
+                shell = fssh.SaltShell([], fssh.opts)
+                shell.load_pillars()
+            for name, fun in benchmarks(fssh, shell, size):
+                if only and not any(name.startswith(prefix) for prefix in only):
+                    continue
+                best = None
+                for i in xrange(opts.repeat):
+                    with Quiet():
+                        start = time.time()
+                        fun()
+                        took = time.time() - start
+                    best = best is None and took or min(best, took)
+                results[name] = best
+                print "{0:<45} {1:>10.4f}s".format(name, best)
+                sys.stdout.flush()
+    finally:
+        root.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline):
+    """ Print every result next to its baseline. Returns the names of
+        the ones more than tolerance percent slower, ignoring anything
+        under a few milliseconds which is mostly noise, and whether the
+        baseline was taken on this host with the same options at all. """
+    slower = []
+    comparable = True
+    taken = baseline.get('params', {})
+    for name in sorted(params):
+        if taken.get(name) != params[name]:
+            print "The baseline was taken with {0} = {1}, this run has {2}.".format(name, taken.get(name), params[name])
+            comparable = False
+    print
+    print "{0:<45} {1:>10} {2:>10} {3:>8}".format('BENCHMARK', 'BASELINE', 'NOW', 'CHANGE')
+    for name in results:
+        before = baseline.get('results', {}).get(name)
+        if not before:
+            print "{0:<45} {1:>10} {2:>10.4f}".format(name, '-', results[name])
+            continue
+        change = (results[name] - before) / before * 100
+        flag = ''
+        if change > opts.tolerance and results[name] - before > 0.005:
+            slower.append(name)
+            flag = '  <-- slower'
+        print "{0:<45} {1:>10.4f} {2:>10.4f} {3:>+7.1f}%{4}".format(name, before, results[name], change, flag)
+    return slower, comparable
+
+
+sizes = [int(size) for size in opts.sizes.split(',')]
+params = {'host': socket.gethostname(), 'sizes': sizes, 'latency': opts.latency, 'output_size': opts.output_size}
+
+if __name__ == '__main__':
+    results = run_benchmarks()
+    if opts.save:
+        with open(opts.baseline, 'w') as fd:
+            json.dump({'params': params, 'results': results}, fd, indent=4, sort_keys=True)
+            fd.write('\n')
+        print "Saved baseline to {0}".format(opts.baseline)
+        sys.exit(0)
+    if not os.path.exists(opts.baseline):
+        print "No baseline at {0}, run with --save to store one.".format(opts.baseline)
+        sys.exit(0)
+    with open(opts.baseline) as fd:
+        slower, comparable = compare(results, json.load(fd))
+    if slower and not comparable:
+        print "{0} benchmarks are slower, but the baseline isn't from this run's host and options. Run --save here first.".format(len(slower))
+    elif slower:
+        print "{0} benchmarks are more than {1:g}% slower than the baseline.".format(len(slower), opts.tolerance)
+        sys.exit(1)
@@ -0,0 +1,170 @@
+# fakesalt - the parts of salt fssh talks to, for the tests
+#
+# Copyright (C) 2015-2016 Eric Webster <sophomeric@gmail.com>
+# see COPYING for license details
+
+# Every FakeMaster is registered under its config path, and the clients
+# salt.client/salt.runner would build for that path talk to it instead.
+# load_fssh() imports fssh.py with these in place of salt. fssh_bench.py
+# loads it the same way, with clients of its own.
+
+import atexit
+import imp
+import os
+import re
+import shutil
+import sys
+import tempfile
+import types
+
+here = os.path.dirname(os.path.abspath(__file__))
+masters = {}
+
+# fssh flushes its result store at exit, so what the tests leave on disk
+# has to outlive them. Registered before fssh registers anything, so
+# it's removed after.
+scratch = tempfile.mkdtemp(prefix='fssh-test-')
+atexit.register(shutil.rmtree, scratch, True)
+
+
+def tempdir():
+    return tempfile.mkdtemp(dir=scratch)
+
+
+class FakeMaster(object):
+    """ A master with a fixed set of minions, which all return
+        returns[minion] (or 'ok') to anything. With lag set the job
+        cache doesn't know about any job yet. """
+
+    def __init__(self, path, minions, returns=None):
+        self.path = path
+        self.minions = minions
+        self.returns = returns or {}
+        self.jobs = {}
+        self.jid = 0
+        self.lag = False
+        masters[path] = self
+
+    def match(self, tgt):
+        """ Only the E@ parts of a compound target are understood. """
+        regexes = re.findall(r'(?:^| )E@(\S+)', tgt)
+        return [m for m in self.minions if all(re.match(r, m) for r in regexes)]
+
+    def publish(self, tgt, fun, arg):
+        self.jid += 1
+        jid = str(self.jid)
+        self.jobs[jid] = (fun, arg, self.match(tgt))
+        return jid, self.jobs[jid][2]
+
+    def list_job(self, jid):
+        if self.lag or jid not in self.jobs:
+            return {}
+        minions = self.jobs[jid][2]
+        return {'Minions': minions,
+                'Result': dict((m, {'return': self.returns.get(m, 'ok'), 'retcode': 0}) for m in minions)}
+
+
+class LocalClient(object):
+    def __init__(self, c_path='/etc/salt/master', **kwargs):
+        self.master = masters[c_path]
+
+    def run_job(self, tgt, fun, arg=(), **kwargs):
+        jid, minions = self.master.publish(tgt, fun, arg)
+        return {'jid': jid, 'minions': minions}
+
+    def cmd_async(self, tgt, fun, arg=(), **kwargs):
+        return self.master.publish(tgt, fun, arg)[0]
+
+
+class RunnerClient(object):
+    def __init__(self, opts):
+        self.master = masters[opts['conf_file']]
+
+    def cmd(self, fun, arg=(), **kwargs):
+        if fun == 'jobs.list_job':
+            return self.master.list_job(arg[0])
+        return {}
+
+
+class FakeEvents(object):
+    """ Stands in for fssh's EventSource: get_return() hands out the
+        given (jid, minion, data) returns in order, and None once there
+        are no more. """
+
+    def __init__(self, returns):
+        self.pending = list(returns)
+        self.calls = 0
+
+    def get_return(self, jids, wait):
+        self.calls += 1
+        for i, (jid, minion, data) in enumerate(self.pending):
+            if jids is None or jid in jids:
+                return self.pending.pop(i)
+        return None
+
+
+def fake_salt(local_client=LocalClient, runner_client=RunnerClient, master_event=None):
+    """ The salt modules fssh imports, with these clients in them. The
+        bench passes its own, simulating a whole fleet. """
+    modules = {}
+    for name in ['salt', 'salt.client', 'salt.runner', 'salt.config', 'salt.utils', 'salt.utils.event']:
+        modules[name] = types.ModuleType(name)
+    modules['salt.client'].LocalClient = local_client
+    modules['salt.runner'].RunnerClient = runner_client
+    modules['salt.config'].master_config = lambda path: {'conf_file': path, 'sock_dir': path}
+    if master_event:
+        modules['salt.utils.event'].get_master_event = master_event
+    for name, module in modules.items():
+        if '.' in name:
+            parent, child = name.rsplit('.', 1)
+            setattr(modules[parent], child, module)
+    return modules
+
+
+def load_fssh(args=('-p',), modules=None):
+    """ Import fssh.py with args on its command line and modules
+        (fake_salt() by default) in place of salt, without it
+        re-running itself through sudo. """
+    sys.modules.update(modules or fake_salt())
+    saved = sys.argv, os.geteuid, os.getuid
+    sys.argv = [os.path.join(here, '..', 'fssh.py')] + list(args)
+    os.geteuid = os.getuid = lambda: 0
+    try:
+        return imp.load_source('fssh', os.path.join(here, '..', 'fssh.py'))
+    finally:
+        sys.argv, os.geteuid, os.getuid = saved
+
+
+class AsRoot(object):
+    """ fssh checks for root whenever it's about to talk to salt, so
+        this pretends to be root until stop(), or the end of a with. """
+
+    def __init__(self):
+        self.saved = os.geteuid, os.getuid
+        os.geteuid = os.getuid = lambda: 0
+
+    def stop(self):
+        os.geteuid, os.getuid = self.saved
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def write_config(directory, masters=None, **main):
+    """ A config file in directory with main as its [main] section,
+        keeping the caches and results in there too. """
+    main.setdefault('cache_dir', directory)
+    main.setdefault('result_db', os.path.join(directory, 'results.db'))
+    path = os.path.join(directory, 'fssh.conf')
+    with open(path, 'w') as fd:
+        fd.write("[main]\n")
+        for name, value in sorted(main.items()):
+            fd.write("{0} = {1}\n".format(name, value))
+        if masters:
+            fd.write("[masters]\n")
+            for name, config in masters:
+                fd.write("{0} = {1}\n".format(name, config))
+    return path
@@ -0,0 +1,68 @@
+import os
+import re
+import StringIO
+import sys
+import unittest
+
+import fakesalt
+
+fssh = fakesalt.load_fssh()
+
+
+class HostListTest(unittest.TestCase):
+    """ '< file' and the regexes host lists get compressed into. """
+
+    def setUp(self):
+        self.dir = fakesalt.tempdir()
+        fssh.opts.config = fakesalt.write_config(self.dir)
+        self.shell = fssh.SaltShell([], fssh.opts)
+
+    def test_host_file(self):
+        path = os.path.join(self.dir, 'hosts')
+        with open(path, 'w') as fd:
+            fd.write("# incident hosts for db1 outage\n\n  web1  \nweb2\n   # web3 is fine\n")
+        self.shell.parse_and_run('< {0}'.format(path))
+        self.assertEqual(self.shell.filters[-1][2].hosts, ['web1', 'web2'])
+        targets = self.shell.compile_targets()
+        self.assertEqual(len(targets), 1)
+        self.assertNotIn('db1', targets[0])
+        self.assertNotIn('incident', targets[0])
+
+    def test_empty_host_file(self):
+        path = os.path.join(self.dir, 'hosts')
+        with open(path, 'w') as fd:
+            fd.write("# nothing yet\n\n")
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            self.shell.parse_and_run('< {0}'.format(path))
+            self.assertIn("No hosts given.", sys.stdout.getvalue())
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(self.shell.filters, [])
+
+    def test_hosts_to_regex(self):
+        hosts = ['web1.example.com', 'web2.example.com', 'web10.example.com', 'db1.example.com']
+        regex = re.compile(fssh.hosts_to_regex(hosts))
+        for host in hosts:
+            self.assertTrue(regex.match(host), host)
+        for host in ['web1', 'web3.example.com', 'web1.example.com.evil', 'db10.example.com',
+                     'web1xexample.com', 'eweb1.example.com']:
+            self.assertFalse(regex.match(host), host)
+        self.assertEqual(fssh.hosts_to_regex(['web1']), 'web1$')
+
+    def test_shard_hosts(self):
+        hosts = sorted("node{0:04d}.example.com".format(i) for i in range(0, 2000, 3))
+        whole = fssh.shard_hosts(hosts, 100000)
+        self.assertEqual(len(whole), 1)
+        shards = fssh.shard_hosts(hosts, 200)
+        self.assertTrue(len(shards) > 1)
+        self.assertTrue(all(len(shard) <= 200 for shard in shards))
+        for host in hosts:
+            self.assertEqual(sum(1 for shard in shards if re.match(shard, host)), 1, host)
+        self.assertFalse(any(re.match(shard, 'node0001.example.com') for shard in shards))
+        # One host can't be split any further, however long it is.
+        self.assertEqual(fssh.shard_hosts(['x' * 50], 10), ['x' * 50 + '$'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import StringIO
+import sys
+import unittest
+
+import fakesalt
+
+fssh = fakesalt.load_fssh()
+
+
+class MastersTest(unittest.TestCase):
+    """ Jobs going to two masters at once, and their results coming
+        back as one. """
+
+    def setUp(self):
+        self.addCleanup(fakesalt.AsRoot().stop)
+        self.dir = fakesalt.tempdir()
+        fssh.opts.config = fakesalt.write_config(self.dir, masters=[('us', '/fake/us'), ('eu', '/fake/eu')])
+        self.us = fakesalt.FakeMaster('/fake/us', ['web1.us', 'web2.us', 'db1.us'],
+                                      {'web1.us': 'up 1 us', 'web2.us': 'up 2 us'})
+        self.eu = fakesalt.FakeMaster('/fake/eu', ['web1.eu'], {'web1.eu': 'up 1 eu'})
+        self.shell = fssh.SaltShell([], fssh.opts)
+
+    def capture(self, fun, *args):
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            fun(*args)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def publish(self):
+        tracked = fssh.Job('E@web.*', 'uptime')
+        self.shell.jobs.add(tracked)
+        messages = self.shell.publish(tracked, ['E@web.*'], 'cmd.shell', ['uptime'], {})
+        return tracked, messages
+
+    def test_on_masters(self):
+        results = self.shell.on_masters(lambda master: master.client.master.path)
+        self.assertEqual(sorted((master.name, path) for master, path in results),
+                         [('eu', '/fake/eu'), ('us', '/fake/us')])
+
+    def test_publish_tags_jids(self):
+        tracked, messages = self.publish()
+        # Both masters hand out jid 1, the tags tell them apart.
+        self.assertEqual(sorted(tracked.jids), ['1@eu', '1@us'])
+        self.assertEqual(tracked.sent['1@us'], set(['web1.us', 'web2.us']))
+        self.assertEqual(tracked.sent['1@eu'], set(['web1.eu']))
+        self.assertEqual(tracked.expected, set(['web1.us', 'web2.us', 'web1.eu']))
+        self.assertEqual(messages, [])
+        self.assertEqual(self.shell.split_jid('1@eu'), ('1', self.shell.masters[1]))
+        self.assertIs(self.shell.jobs.find('1@us'), tracked)
+
+    def test_merged_lookup(self):
+        tracked, messages = self.publish()
+        self.shell.job = list(tracked.jids)
+        self.shell.fetch_jobs(self.shell.job)
+        self.assertEqual(self.shell.results.returns('1@us'),
+                         {'web1.us': ('up 1 us', 0), 'web2.us': ('up 2 us', 0)})
+        self.assertEqual(self.shell.results.returns('1@eu'), {'web1.eu': ('up 1 eu', 0)})
+        output = self.capture(self.shell.run_query)
+        self.assertEqual(output.splitlines(), ['web1.eu:', '    up 1 eu',
+                                               'web1.us:', '    up 1 us',
+                                               'web2.us:', '    up 2 us'])
+
+    def test_unknown_master(self):
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            self.shell.fetch_jobs(['1@ap'])
+            self.assertIn("There's no master ap in [masters].", sys.stderr.getvalue())
+        finally:
+            sys.stderr = stderr
+
+
+if __name__ == '__main__':
+    unittest.main()
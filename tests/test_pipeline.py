@@ -0,0 +1,87 @@
+import threading
+import unittest
+
+import fakesalt
+
+fssh = fakesalt.load_fssh()
+
+
+class PipelineTest(unittest.TestCase):
+    """ Jobs that might reach the same minions go out in script order,
+        the others don't wait on each other. """
+
+    def setUp(self):
+        self.pipeline = fssh.Pipeline(4)
+        self.order = []
+        self.gates = {}
+
+    def add(self, name, minions):
+        gate = self.gates[name] = threading.Event()
+
+        def work():
+            gate.wait(5)
+            self.order.append(name)
+            return [name]
+        self.pipeline.add(fssh.Job(name, name), minions, work)
+
+    def test_overlapping_in_order(self):
+        self.add('first', set([1, 2]))
+        self.add('second', set([2, 3]))
+        self.add('apart', set([4]))
+        # 'apart' doesn't wait on anything, 'second' waits on 'first'.
+        self.gates['apart'].set()
+        self.gates['second'].set()
+        self.assertTrue(self.wait_for('apart'))
+        self.assertEqual(self.order, ['apart'])
+        self.gates['first'].set()
+        drained = self.pipeline.drain()
+        self.assertEqual(self.order, ['apart', 'first', 'second'])
+        # Handed back in script order, whatever order they went out in.
+        self.assertEqual([s.messages for s in drained], [['first'], ['second'], ['apart']])
+
+    def test_unknown_overlaps_everything(self):
+        self.add('first', set([1]))
+        self.add('unknown', None)
+        self.add('last', set([2]))
+        self.gates['last'].set()
+        self.gates['unknown'].set()
+        self.gates['first'].set()
+        self.pipeline.drain()
+        self.assertEqual(self.order, ['first', 'unknown', 'last'])
+
+    def wait_for(self, name):
+        for i in range(500):
+            if name in self.order:
+                return True
+            threading.Event().wait(0.01)
+        return False
+
+
+class PipelinedScriptTest(unittest.TestCase):
+    """ A pipelined script with an empty pillar index, as with
+        minion_data_cache off. """
+
+    def setUp(self):
+        self.addCleanup(fakesalt.AsRoot().stop)
+        self.dir = fakesalt.tempdir()
+        fssh.opts.config = fakesalt.write_config(self.dir)
+        self.master = fakesalt.FakeMaster('/etc/salt/master', ['web1', 'web2'])
+        self.shell = fssh.SaltShell([], fssh.opts)
+        self.shell.index = fssh.PillarIndex()
+        # No background tracker, there's no event bus for it.
+        self.shell.tracker = False
+
+    def test_empty_index(self):
+        self.shell.pipeline = fssh.Pipeline(2)
+        self.shell.parse_and_run('+ web.*')
+        self.shell.parse_and_run('uptime')
+        self.shell.parse_and_run('hostname')
+        drained = self.shell.pipeline.drain()
+        self.assertEqual([s.minions for s in drained], [None, None])
+        self.assertEqual([s.job.jids for s in drained], [['1'], ['2']])
+        self.assertEqual(self.shell.jobs.jobs, [s.job for s in drained])
+        self.assertEqual([self.master.jobs[jid][1] for jid in ['1', '2']], [['uptime'], ['hostname']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import sqlite3
+import StringIO
+import sys
+import unittest
+
+import fakesalt
+
+fssh = fakesalt.load_fssh()
+
+
+class ResultStoreTest(unittest.TestCase):
+    """ The result store shared by every fssh on the host. """
+
+    def setUp(self):
+        self.dir = fakesalt.tempdir()
+        self.path = os.path.join(self.dir, 'results.db')
+
+    def test_writes_are_committed(self):
+        first = fssh.ResultStore(self.path, 7, 0.1)
+        first.add_many('1', {'web1': {'return': 'up', 'retcode': 0}})
+        first.set_expected('1', ['web1', 'web2'])
+        # Nothing is left open, so a second store can write straight away.
+        second = fssh.ResultStore(self.path, 7, 0.1)
+        second.add('1', 'web2', {'return': 'up too', 'retcode': 1})
+        second.mark_complete('1')
+        self.assertEqual(first.returns('1'), {'web1': ('up', 0), 'web2': ('up too', 1)})
+        self.assertTrue(first.is_complete('1'))
+
+    def test_locked_write_is_not_complete(self):
+        store = fssh.ResultStore(self.path, 7, 0.1)
+        other = sqlite3.connect(self.path)
+        other.execute('BEGIN IMMEDIATE')
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            store.add_many('1', {'web1': 'up'})
+            store.mark_complete('1')
+            self.assertIn("Couldn't save returns of 1", sys.stderr.getvalue())
+        finally:
+            sys.stderr = stderr
+            other.rollback()
+        self.assertFalse(store.is_complete('1'))
+
+
+class LockedLookupTest(unittest.TestCase):
+    """ A lookup while another fssh holds the store. """
+
+    def setUp(self):
+        self.addCleanup(fakesalt.AsRoot().stop)
+        self.dir = fakesalt.tempdir()
+        fssh.opts.config = fakesalt.write_config(self.dir, result_busy_timeout=0.1)
+        self.master = fakesalt.FakeMaster('/etc/salt/master', ['web1', 'web2'], {'web1': 'up 1', 'web2': 'up 2'})
+        self.shell = fssh.SaltShell([], fssh.opts)
+
+    def test_asks_the_master(self):
+        jid = self.master.publish('E@web.*', 'cmd.shell', ['uptime'])[0]
+        self.shell.results
+        other = sqlite3.connect(os.path.join(self.dir, 'results.db'))
+        other.execute('BEGIN EXCLUSIVE')
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            self.shell.parse_and_run('? {0}'.format(jid))
+            output, errors = sys.stdout.getvalue(), sys.stderr.getvalue()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            other.rollback()
+        self.assertIn("asking the master instead", errors)
+        self.assertEqual(output.splitlines(), ['web1:', '    up 1', 'web2:', '    up 2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
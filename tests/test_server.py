@@ -0,0 +1,49 @@
+import unittest
+
+import fakesalt
+
+fssh = fakesalt.load_fssh()
+
+
+class ServeRequestTest(unittest.TestCase):
+    """ Requests to --server don't leave anything behind for the next
+        one. """
+
+    def setUp(self):
+        self.addCleanup(fakesalt.AsRoot().stop)
+        self.dir = fakesalt.tempdir()
+        fssh.opts.config = fakesalt.write_config(self.dir)
+        self.master = fakesalt.FakeMaster('/etc/salt/master', ['web1', 'web2'])
+        self.shell = fssh.SaltShell([], fssh.opts)
+        # No background tracker, there's no event bus for it.
+        self.shell.tracker = False
+
+    def test_settings_undone(self):
+        reply = self.shell.serve_request({'lines': ['group on', 'batch 1', '+ web.*']})
+        self.assertFalse(reply['error'])
+        self.assertFalse(self.shell.group_output)
+        self.assertEqual((self.shell.filters, self.shell.batch), ([], None))
+
+    def test_no_output_dir(self):
+        reply = self.shell.serve_request({'lines': ['output {0}'.format(self.dir), '+ web.*', 'uptime']})
+        self.assertTrue(reply['error'])
+        self.assertIn("Output directories can only be set for the whole server", reply['output'])
+        self.assertIsNone(self.shell.writer)
+        self.assertEqual(self.master.jobs['1'][0], 'cmd.shell')
+
+    def test_jobs_forgotten(self):
+        reply = self.shell.serve_request({'lines': ['+ web.*', 'uptime']})
+        self.assertEqual(reply['jobs'][0]['jids'], ['1'])
+        job = self.shell.jobs.find('1')
+        # Still running, so it's kept until it's done.
+        self.assertEqual(self.shell.jobs.jobs, [job])
+        self.shell.jobs.record('1', 'web1', {'return': 'up', 'retcode': 0})
+        self.shell.jobs.record('1', 'web2', {'return': 'up', 'retcode': 0})
+        self.assertEqual(job.state, 'done')
+        self.shell.serve_request({'lines': ['?']})
+        self.assertEqual(self.shell.jobs.jobs, [])
+        self.assertIsNone(self.shell.jobs.find('1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
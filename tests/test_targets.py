@@ -0,0 +1,156 @@
+import StringIO
+import sys
+import unittest
+
+import fakesalt
+
+fssh = fakesalt.load_fssh()
+
+
+class ClauseTest(unittest.TestCase):
+    """ What a filter stack compiles down to, before any master sees it. """
+
+    def test_duplicates_dropped(self):
+        clauses = [(False, 'E', 'web'), (False, 'E', 'web'), (False, 'I', 'role:web'), (False, 'I', 'role:web')]
+        self.assertEqual(fssh.optimize_clauses(clauses), [(False, 'E', 'web'), (False, 'I', 'role:web')])
+
+    def test_match_all_dropped(self):
+        self.assertEqual(fssh.optimize_clauses([(False, 'E', '.*'), (False, 'E', 'web')]), [(False, 'E', 'web')])
+        # Unless it's all there is.
+        self.assertEqual(fssh.optimize_clauses([(False, 'E', '.*'), (False, 'E', '.*')]), [(False, 'E', '.*')])
+
+    def test_subsumed_pillar_dropped(self):
+        clauses = [(False, 'I', 'role:*'), (False, 'I', 'role:web'), (False, 'I', 'env:*')]
+        self.assertEqual(fssh.optimize_clauses(clauses), [(False, 'I', 'role:web'), (False, 'I', 'env:*')])
+        # An excluded value doesn't imply the key is there.
+        clauses = [(False, 'I', 'role:*'), (True, 'I', 'role:web')]
+        self.assertEqual(fssh.optimize_clauses(clauses), [(False, 'I', 'role:*'), (True, 'I', 'role:web')])
+
+    def test_excludes_merged(self):
+        clauses = [(True, 'E', 'db'), (False, 'E', 'web'), (True, 'E', 'cache'), (False, 'E', 'prod')]
+        self.assertEqual(fssh.optimize_clauses(clauses),
+                         [(False, 'E', 'web'), (False, 'E', 'prod'), (True, 'E', '(?:db|cache)')])
+        # A single exclude is left as it is.
+        self.assertEqual(fssh.optimize_clauses([(True, 'E', 'db')]), [(True, 'E', 'db')])
+
+    def test_regexes_before_pillars(self):
+        filters = [['+', 'role', '==', 'web'], ['-', 'db'], ['+', 'web'], ['-', 'env', '==', 'dev']]
+        self.assertEqual(fssh.get_salt_filters(filters, None),
+                         "E@web and not E@db and I@role:web and not I@env:dev")
+
+    def test_contradictions(self):
+        self.assertEqual(fssh.find_contradictions([['+', 'web'], ['-', 'web']]),
+                         ["E@web is both included and excluded."])
+        self.assertEqual(fssh.find_contradictions([['+', 'role', '==', 'web'], ['+', 'role', '!=', 'web']]),
+                         ["I@role:web is both included and excluded."])
+        # '- role != web' is the same as '+ role == web'.
+        self.assertEqual(fssh.find_contradictions([['+', 'role', '==', 'web'], ['-', 'role', '!=', 'web']]), [])
+        self.assertEqual(fssh.find_contradictions([['-', '.*']]), ["not E@.* excludes every host."])
+        self.assertEqual(fssh.find_contradictions([['+', 'web'], ['-', 'db']]), [])
+
+
+class PillarIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = fssh.PillarIndex()
+        self.index.update({
+            'web1': {'role': 'web', 'env': 'prod', 'tags': ['a', 'b']},
+            'web2': {'role': 'Web', 'env': 'dev', 'net': {'dc': 'us'}},
+            'db1': {'role': 'db', 'env': 'prod', 'net': {'dc': 'eu'}},
+        })
+
+    def names(self, filters):
+        return self.index.names(self.index.select(filters))
+
+    def test_select(self):
+        self.assertEqual(self.names([['+', 'role', '==', 'web']]), ['web1', 'web2'])
+        self.assertEqual(self.names([['+', 'role', '==', 'web'], ['-', 'env', '==', 'dev']]), ['web1'])
+        self.assertEqual(self.names([['+', 'role', '!=', 'web']]), ['db1'])
+        self.assertEqual(self.names([['+', 'net:dc', '==', 'e*']]), ['db1'])
+        self.assertEqual(self.names([['+', 'tags', '==', 'b']]), ['web1'])
+        self.assertEqual(self.names([['+', 'web'], ['-', 'web2']]), ['web1'])
+        self.assertEqual(self.names([['+', '(bad']]), [])
+
+    def test_resolve(self):
+        filters = [['+', 'env', '==', 'prod'], ['+', 'web'], ['-', 'role', '==', 'web']]
+        self.assertEqual(self.index.resolve(filters), [(filters[0], 2, 2), (filters[1], 2, 1), (filters[2], 1, 0)])
+
+    def test_update(self):
+        self.assertEqual(self.index.update({'web1': {'role': 'web', 'env': 'prod', 'tags': ['a', 'b']},
+                                            'db1': {'role': 'web'}}), 2)
+        self.assertEqual(self.names([['+', 'role', '==', 'web']]), ['db1', 'web1'])
+        self.assertEqual(len(self.index), 2)
+
+
+class HostRangesTest(unittest.TestCase):
+
+    def ranges(self, hosts):
+        ranges = fssh.HostRanges()
+        for host in hosts:
+            ranges.add(host)
+        return str(ranges), ranges.count
+
+    def test_ranges(self):
+        hosts = ['web{0:04d}.example.com'.format(n) for n in [3, 1, 2, 7, 5, 6, 10]]
+        self.assertEqual(self.ranges(hosts), ("web[0001-0003,0005-0007,0010].example.com", 7))
+
+    def test_widths(self):
+        self.assertEqual(self.ranges(['web9', 'web10', 'web11', 'web08'])[0], "web9,web[08,10-11]")
+
+    def test_singles_and_others(self):
+        self.assertEqual(self.ranges(['db1', 'mail', 'web01.us', 'web01.eu'])[0], "db1,mail,web01.eu,web01.us")
+
+    def test_duplicates(self):
+        self.assertEqual(self.ranges(['web1', 'web2', 'web1', 'mail', 'mail']), ("mail,web[1-2]", 5))
+
+
+class ReducedOutputTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def test_stats(self):
+        output = fssh.ReducedOutput('stats', 2)
+        output.add('web1', "/ 10%\n/var 40%")
+        output.add('web2', "/ 20%")
+        output.add('web3', "/ full")
+        output.add('web4', {'not': 'a number'})
+        output.finish()
+        printed = sys.stdout.getvalue()
+        self.assertIn("stats $2 over 3 values", printed)
+        self.assertIn("No number in field $2 from 2 minions: web[3-4]", printed)
+        self.assertIn("count 3  sum 70  mean 23.3333", printed)
+        self.assertIn("min 10  p50 20  p90 40  p99 40  max 40", printed)
+        self.assertIn("Lowest:  web1 (10), web2 (20), web1 (40)", printed)
+        self.assertIn("Highest: web1 (40), web2 (20), web1 (10)", printed)
+
+    def test_whole_line(self):
+        output = fssh.ReducedOutput('stats', 0)
+        output.add('web1', " 1.5 \n")
+        output.add('web2', "2.5 load")
+        output.finish()
+        self.assertIn("count 1  sum 1.5", sys.stdout.getvalue())
+
+    def test_hist(self):
+        output = fssh.ReducedOutput('hist', 1)
+        output.bins = 2
+        for n in xrange(10):
+            output.add('web{0}'.format(n), str(n))
+        output.finish()
+        lines = sys.stdout.getvalue().splitlines()
+        self.assertEqual([line.split()[:4] for line in lines[1:3]], [['0', '-', '4.5', '5'], ['4.5', '-', '9', '5']])
+
+    def test_nothing(self):
+        output = fssh.ReducedOutput('hist', 1)
+        output.add('web1', "")
+        output.finish()
+        printed = sys.stdout.getvalue()
+        self.assertIn("hist $1 over 0 values", printed)
+        self.assertNotIn("Lowest", printed)
+
+
+if __name__ == '__main__':
+    unittest.main()
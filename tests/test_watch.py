@@ -0,0 +1,103 @@
+import StringIO
+import sys
+import unittest
+
+import fakesalt
+
+fssh = fakesalt.load_fssh()
+
+
+class WatchTest(unittest.TestCase):
+    """ 'watch' against a fake event source instead of a master. """
+
+    def setUp(self):
+        self.addCleanup(fakesalt.AsRoot().stop)
+        self.dir = fakesalt.tempdir()
+        fssh.opts.config = fakesalt.write_config(self.dir, watch_timeout=0.1)
+        self.master = fakesalt.FakeMaster('/etc/salt/master', ['web1', 'web2', 'web3', 'db1'])
+        self.shell = fssh.SaltShell([], fssh.opts)
+
+    def watch(self, returns):
+        self.shell.events = fakesalt.FakeEvents(returns)
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            self.shell.run_watch()
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_counts_and_stops_when_all_returned(self):
+        jid = self.master.publish('E@web.*', 'cmd.shell', ['uptime'])[0]
+        self.shell.job = [jid]
+        # web1 is in the job cache already, the rest comes off the bus.
+        listed = self.master.list_job
+        self.master.list_job = lambda j: dict(listed(j), Result={'web1': {'return': 'up 1', 'retcode': 0}})
+        late = (jid, 'db1', {'return': 'not part of it', 'retcode': 0})
+        events = [(jid, 'web2', {'return': 'up 2', 'retcode': 0}),
+                  (jid, 'web3', {'return': 'up 3', 'retcode': 1}),
+                  late]
+        output = self.watch(events)
+        self.assertIn("[1/3] web1:", output)
+        self.assertIn("[2/3] web2:", output)
+        self.assertIn("[3/3] web3: (retcode 1)", output)
+        self.assertIn("All 3 minions returned.", output)
+        self.assertEqual(self.shell.events.pending, [late])
+
+    def test_stops_on_timeout(self):
+        jid = self.master.publish('E@web.*', 'cmd.shell', ['uptime'])[0]
+        self.shell.job = [jid]
+        self.master.list_job = lambda j: {'Minions': ['web1', 'web2', 'web3'], 'Result': {}}
+        output = self.watch([(jid, 'web2', {'return': 'up', 'retcode': 0})])
+        self.assertIn("[1/3] web2:", output)
+        self.assertIn("stopped watching. 1/3 returned.", output)
+        self.assertIn("2 of 3 targeted minions have not returned: web[1,3]", output)
+
+    def test_job_cache_lagging(self):
+        # The job cache doesn't know the job yet, but this session
+        # published it, so it knows where it went.
+        self.master.lag = True
+        tracked = fssh.Job('E@web[12]', 'uptime')
+        self.shell.jobs.add(tracked)
+        self.shell.jobs.add_jid(tracked, '7')
+        tracked.sent['7'] = set(['web1', 'web2'])
+        self.shell.job = ['7']
+        output = self.watch([('7', 'web1', {'return': 'up', 'retcode': 0}),
+                             ('7', 'web2', {'return': 'up', 'retcode': 0})])
+        self.assertIn("[2/2] web2:", output)
+        self.assertIn("All 2 minions returned.", output)
+
+    def test_reduce(self):
+        self.master.returns = {'web1': 'load 1.5', 'web2': 'load 0.5', 'web3': 'load 4'}
+        self.shell.parse_and_run('+ web.*')
+        self.shell.events = fakesalt.FakeEvents([])
+        # No background tracker, there's no event bus for it.
+        self.shell.tracker = False
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            self.shell.parse_and_run('reduce stats $2 uptime | cut -c 30-')
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(self.master.jobs['1'][:2], ('cmd.shell', ['uptime | cut -c 30-']))
+        self.assertIn("stats $2 over 3 values", output)
+        self.assertIn("count 3  sum 6  mean 2", output)
+        self.assertIn("All 3 minions returned.", output)
+        self.assertIsNone(self.shell.reduction)
+
+    def test_needs_root(self):
+        geteuid, fssh.os.geteuid = fssh.os.geteuid, lambda: 1000
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            with self.assertRaises(fssh.NeedsRoot):
+                self.shell.get_events()
+            # Only the command is over, not the session.
+            self.shell.parse_and_run('watch 5')
+            self.shell.parse_and_run('? 5')
+            self.assertEqual(sys.stderr.getvalue().count("Talking to salt needs root."), 2)
+        finally:
+            fssh.os.geteuid = geteuid
+            sys.stderr = stderr
+
+
+if __name__ == '__main__':
+    unittest.main()